@@ -0,0 +1,52 @@
+"""Deterministic nixpkgs-like data for the fake nix commands"""
+import hashlib
+import json
+import os
+import sys
+
+
+def log_invocation():
+    """Record the command line in $NOX_BENCH_LOG, one json list per line"""
+    path = os.environ.get('NOX_BENCH_LOG')
+    if path:
+        with open(path, 'a') as f:
+            f.write(json.dumps([os.path.basename(sys.argv[0])] + sys.argv[1:]) + '\n')
+
+
+def store_hash(*parts):
+    return hashlib.sha256(' '.join(parts).encode()).hexdigest()[:32]
+
+
+def arg(args, name, default=None):
+    """Value of --arg name or --argstr name in args"""
+    for i, a in enumerate(args[:-2]):
+        if a in ('--arg', '--argstr') and args[i + 1] == name:
+            return args[i + 2]
+    return default
+
+
+def option(args, name, default=None):
+    """Value following the option name in args"""
+    if name in args[:-1]:
+        return args[args.index(name) + 1]
+    return default
+
+
+def packages(variant=''):
+    """(attr, name, out path) of the packages of a nixpkgs
+
+    There are $NOX_BENCH_PACKAGES of them. One in a hundred has a different
+    out path in each variant, like a commit rebuilding 1% of nixpkgs.
+    """
+    for i in range(int(os.environ.get('NOX_BENCH_PACKAGES', 80000))):
+        attr = 'pkg{}'.format(i) if i % 10 else 'pythonPackages.pkg{}'.format(i)
+        name = 'pkg{}-{}.{}.0'.format(i, i % 7, i % 13)
+        salt = variant if i % 100 == 0 else ''
+        yield attr, name, '/nix/store/{}-{}'.format(store_hash(name, salt), name)
+
+
+def tests():
+    """(attr, drv path) of the NixOS tests, $NOX_BENCH_TESTS of them"""
+    for i in range(int(os.environ.get('NOX_BENCH_TESTS', 500))):
+        name = 'vm-test-run-test{}'.format(i)
+        yield 'tests.test{}'.format(i), '/nix/store/{}-{}.drv'.format(store_hash(name), name)
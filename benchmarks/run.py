@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Measure the hot paths of nox against fake nix commands
+
+Each scenario runs in a new process, with the fake nix-env, nix-store,
+nix-instantiate and nix of benchmarks/fake first in PATH and a cache of its
+own. The latency, the number of nix commands invoked and the peak memory
+of the process are reported, and can be saved to compare commits:
+
+    python benchmarks/run.py --output before.json
+    git checkout other-branch
+    python benchmarks/run.py --compare before.json
+"""
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+# name: command line, given the work directory. The search scenarios query
+# something which isn't found, so that nox doesn't prompt.
+commands = {
+    'search-cold': lambda workdir: [sys.executable, '-m', 'nox.search', '--force-refresh', 'nothing-like-this'],
+    'search-warm': lambda workdir: [sys.executable, '-m', 'nox.search', 'nothing-like-this'],
+    'review': lambda workdir: [sys.executable, os.path.join(here, 'scenarios.py'), 'review', workdir],
+    'review-tests': lambda workdir: [sys.executable, os.path.join(here, 'scenarios.py'), 'review-tests', workdir],
+    'update': lambda workdir: [sys.executable, os.path.join(here, 'scenarios.py'), 'update', workdir],
+}
+
+
+def write_closures(store, size):
+    """Write the derivations of two systems of size nodes, and their paths
+    to store/systems
+
+    The second system has a new glibc, which changes the derivation of
+    almost every node, and one node in 500 has a new version.
+    """
+    os.makedirs(store)
+    rng = random.Random(size)
+    deps = [rng.sample(range(i), min(i, 3)) for i in range(size)]
+    roots = set(range(size)) - {d for ds in deps for d in ds}
+
+    def closure(new):
+        paths = []
+        for i in range(size):
+            if i == 0:
+                name = 'glibc-2.28' if new else 'glibc-2.27'
+            else:
+                name = 'p{}-1.{}'.format(i, i % 10 + (new and i % 500 == 0))
+            inputs = sorted(paths[d] for d in deps[i])
+            paths.append(write_drv(store, name, inputs))
+        return write_drv(store, 'nixos-system-host-18.0{}'.format(9 if new else 3), sorted(paths[i] for i in roots))
+
+    with open(os.path.join(store, 'systems'), 'w') as f:
+        f.write('{} {}\n'.format(closure(False), closure(True)))
+
+
+def write_drv(store, name, inputs):
+    digest = hashlib.sha256(' '.join([name] + inputs).encode()).hexdigest()[:32]
+    path = os.path.join(store, '{}-{}.drv'.format(digest, name))
+    if not os.path.exists(path):
+        with open(path, 'w') as f:
+            f.write('Derive([("out","/nix/store/{}-{}","","")],[{}],[],"x86_64-linux","/bin/sh",[],[])'.format(
+                digest, name, ','.join('("{}",["out"])'.format(i) for i in inputs)))
+    return path
+
+
+def prepare(workdir, closure_size):
+    """Write the nixpkgs, channel and systems used by the scenarios"""
+    for nixpkgs in ('base', 'head'):
+        os.makedirs(os.path.join(workdir, nixpkgs))
+    channel = os.path.join(workdir, 'home', '.nix-defexpr', 'channels', 'nixpkgs')
+    os.makedirs(channel)
+    for name, contents in (('default.nix', '{}: {}'), ('manifest.nix', '[ "nixpkgs" ]')):
+        with open(os.path.join(channel, name), 'w') as f:
+            f.write(contents)
+    write_closures(os.path.join(workdir, 'store'), closure_size)
+
+
+def measure(name, workdir, env):
+    """(seconds, peak memory in kB, nix commands) of one run of the scenario"""
+    log = os.path.join(workdir, 'invocations')
+    if os.path.exists(log):
+        os.unlink(log)
+    env = dict(env, NOX_BENCH_LOG=log)
+    start = time.monotonic()
+    process = subprocess.Popen(commands[name](workdir), env=env, cwd=workdir,
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise click.ClickException('{} failed:\n{}'.format(name, stderr.decode(errors='replace')))
+    invocations = 0
+    if os.path.exists(log):
+        with open(log) as f:
+            invocations = sum(1 for _ in f)
+    return seconds, usage.ru_maxrss, invocations
+
+
+def git_describe():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=root,
+                                       universal_newlines=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.argument('scenarios', nargs=-1, type=click.Choice(sorted(commands)))
+@click.option('--repeat', default=3, type=click.IntRange(min=1), help='Runs of each scenario, the fastest is kept')
+@click.option('--packages', default=80000, help='Number of packages in nixpkgs')
+@click.option('--closure', default=20000, help='Number of derivations in a system closure')
+@click.option('--tests', default=500, help='Number of NixOS tests')
+@click.option('--output', type=click.File('w'), help='Save the results as json')
+@click.option('--compare', type=click.File(), help='Results saved by an earlier run to compare to')
+def main(scenarios, repeat, packages, closure, tests, output, compare):
+    """Benchmark the given scenarios, or all of them"""
+    scenarios = scenarios or list(commands)
+    baseline = json.load(compare)['scenarios'] if compare else {}
+    workdir = tempfile.mkdtemp(prefix='nox-bench-')
+    try:
+        click.echo('Preparing {}'.format(workdir), err=True)
+        prepare(workdir, closure)
+        env = dict(os.environ,
+                   PATH=os.pathsep.join([os.path.join(here, 'fake'), os.environ.get('PATH', '')]),
+                   PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]),
+                   HOME=os.path.join(workdir, 'home'),
+                   XDG_CACHE_HOME=os.path.join(workdir, 'cache'),
+                   NIX_PATH='',
+                   NOX_BENCH_PACKAGES=str(packages),
+                   NOX_BENCH_TESTS=str(tests),
+                   NOX_NO_DAEMON='1')
+
+        results = {}
+        click.echo('{:14} {:>9} {:>10} {:>13}'.format('scenario', 'seconds', 'peak MB', 'nix commands'))
+        for name in scenarios:
+            if name == 'search-warm' and not os.path.exists(os.path.join(workdir, 'cache', 'nox', 'index')):
+                measure('search-cold', workdir, env)
+            runs = [measure(name, workdir, env) for _ in range(repeat)]
+            seconds = min(r[0] for r in runs)
+            results[name] = {'seconds': seconds, 'peak_kb': max(r[1] for r in runs), 'invocations': runs[0][2]}
+            line = '{:14} {:9.3f} {:10.1f} {:13d}'.format(name, seconds, results[name]['peak_kb'] / 1024,
+                                                          results[name]['invocations'])
+            if name in baseline:
+                line += '   {:+.0%} time, {:+.0%} memory'.format(
+                    seconds / baseline[name]['seconds'] - 1,
+                    results[name]['peak_kb'] / baseline[name]['peak_kb'] - 1)
+            click.echo(line)
+    finally:
+        shutil.rmtree(workdir)
+
+    if output:
+        json.dump({'commit': git_describe(),
+                   'parameters': {'packages': packages, 'closure': closure, 'tests': tests},
+                   'scenarios': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
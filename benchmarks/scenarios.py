@@ -0,0 +1,38 @@
+"""Hot paths of nox, each run in its own process by run.py
+
+usage: scenarios.py SCENARIO WORKDIR
+"""
+import os
+import sys
+
+
+def review(workdir):
+    """Packages changed between two nixpkgs, and the commands building them"""
+    from nox.nixpkgs_repo import list_packages, get_build_commands
+    base = list_packages(os.path.join(workdir, 'base'), shards=8)
+    head = list_packages(os.path.join(workdir, 'head'), shards=8)
+    get_build_commands(head - base)
+
+
+def review_tests(workdir):
+    """NixOS tests of a nixpkgs"""
+    from nox.nixpkgs_repo import tests_for_sha
+    os.chdir(os.path.join(workdir, 'head'))
+    tests_for_sha(None)
+
+
+def update(workdir):
+    """Changes between two systems"""
+    from nox.update import main
+    store = os.path.join(workdir, 'store')
+    with open(os.path.join(store, 'systems')) as f:
+        old, new = f.read().split()
+    main(['--quiet', old, new], standalone_mode=False)
+
+
+scenarios = {'review': review, 'review-tests': review_tests, 'update': update}
+
+
+if __name__ == '__main__':
+    name, workdir = sys.argv[1:]
+    scenarios[name](workdir)
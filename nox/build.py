@@ -0,0 +1,306 @@
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from . import trace
+from .cachedir import cache_dir
+from .drv import read_drv
+
+
+class BuildResult:
+    """Outcome of building one attribute
+
+    status is 'ok', 'failed', or 'skipped' when the build was not started
+    because an earlier one failed. Builds which were not needed are 'cached'
+    when the result is already in the store, and 'broken' when the same
+    derivation already failed to build. returncode is the exit code of the
+    nix-build which failed, when the failure is known to be this build's.
+    """
+    def __init__(self, attr, command, status, duration=0.0, log=None, returncode=None):
+        self.attr = attr
+        self.command = command
+        self.status = status
+        self.duration = duration
+        self.log = log
+        self.returncode = returncode
+
+    @property
+    def builder_failed(self):
+        """Whether a builder failed, rather than the evaluation or nix-build
+        being interrupted: nix-build exits with 100 and up then"""
+        return self.status == 'failed' and self.returncode is not None and 100 <= self.returncode < 128
+
+    @property
+    def failed(self):
+        return self.status in ('failed', 'broken')
+
+    def __repr__(self):
+        return "BuildResult(attr={!r}, status={!r}, duration={:.1f})".format(self.attr, self.status, self.duration)
+
+
+def result_link(cwd, label, buildable):
+    """Where the outputs of the buildable are linked, told apart by kind as
+    a package and a NixOS test can have the same attribute"""
+    return os.path.join(cwd, 'result-{}-{}'.format(buildable.kind, label))
+
+
+def link_outputs(paths, link):
+    """Link the out paths to link, link-2, ..., as garbage collector roots"""
+    command = ['nix-store', '--realise', '--add-root', link, '--indirect'] + paths
+    with trace.command_span(command, 'nix-store --realise'):
+        subprocess.check_call(command, stdout=subprocess.DEVNULL)
+
+
+def link_results(builds, cwd):
+    """Link the outputs of the (label, buildable) builds as result_link()"""
+    for label, b in builds:
+        paths = out_paths(b)
+        if not paths:
+            continue
+        try:
+            link_outputs(paths, result_link(cwd, label, b))
+        except (OSError, subprocess.CalledProcessError):
+            click.echo('Warning: could not link the outputs of {}'.format(label), err=True)
+
+
+# activity and result types of nix's internal-json log format
+_building, _substituting = 105, 108
+_build_log_line = 101
+_info = 3
+
+
+def follow_log(stream, out):
+    """Copy the nix-build log from stream to out, timing what was built
+
+    nix-build is run with --log-format internal-json, whose messages and
+    build logs are written as text, other lines as they are. Returns
+    [(paths, seconds)] for each derivation built, with the derivation and
+    its outputs as paths, and for each path substituted.
+    """
+    started = {}
+    activities = []
+    for line in stream:
+        if not line.startswith('@nix '):
+            out.write(line)
+            continue
+        try:
+            event = json.loads(line[len('@nix '):])
+        except ValueError:
+            out.write(line)
+            continue
+        action = event.get('action')
+        if action == 'start':
+            if event.get('type') in (_building, _substituting) and event.get('fields'):
+                started[event['id']] = (event['fields'][0], time.monotonic())
+            if event.get('text') and event.get('level', 0) <= _info:
+                out.write(event['text'] + '\n')
+        elif action == 'stop' and event.get('id') in started:
+            path, start = started.pop(event['id'])
+            paths = {path}
+            if path.endswith('.drv'):
+                try:
+                    paths.update(read_drv(path).outputs.values())
+                except (OSError, ValueError):
+                    pass
+            activities.append((paths, time.monotonic() - start))
+        elif action == 'msg':
+            out.write(event.get('msg', '') + '\n')
+        elif action == 'result' and event.get('type') == _build_log_line and event.get('fields'):
+            out.write(event['fields'][0] + '\n')
+    return activities
+
+
+def build_duration(buildable, activities):
+    """Seconds spent building or substituting the buildable itself, by the
+    follow_log activities: 0 when it was already in the store"""
+    paths = {str(buildable.hash)}.union(out_paths(buildable))
+    return sum(seconds for built, seconds in activities if paths & built)
+
+
+def run_builds(tasks, cwd, jobs=1, keep_going=False):
+    """Run the nix-build commands of the (name, command, builds) tasks, jobs
+    at a time
+
+    Each command builds all the (label, buildable) builds of its task, so
+    nixpkgs is evaluated once per task instead of once per attribute. With
+    several jobs, the output of each command goes to cwd/<name>.log. Unless
+    keep_going, no command is started after one failed. When a command
+    fails, the builds whose outputs are in the store anyway succeeded. The
+    others failed, but without keep_going nix-build stops at the first
+    failure, so which of them did is only known when there is one. The
+    outputs of the successful builds are linked as result_link(). The
+    duration of each build is timed from the log, see follow_log().
+    Returns a BuildResult for each build of each task, in the same order.
+    """
+    failed = threading.Event()
+
+    def run(task):
+        name, command, builds = task
+        if failed.is_set() and not keep_going:
+            return [BuildResult(label, command, 'skipped') for label, _ in builds]
+        click.echo('Invoking {}'.format(' '.join(command)))
+        log = os.path.join(cwd, name + '.log') if jobs > 1 else None
+        with trace.command_span(command, 'build ' + name) as span, \
+                (open(log, 'w', buffering=1) if log else contextlib.nullcontext()) as f:
+            process = subprocess.Popen(command, cwd=cwd, stdout=f, stderr=subprocess.PIPE, universal_newlines=True)
+            activities = follow_log(process.stderr, f or sys.stderr)
+            returncode = process.wait()
+            span['exit_code'] = returncode
+
+        paths = {label: out_paths(b) for label, b in builds}
+        succeeded = {label for label, _ in builds}
+        if returncode:
+            failed.set()
+            click.secho('The invocation of "{}" failed'.format(' '.join(command)), fg='red')
+            try:
+                invalid = invalid_paths(sorted({p for ps in paths.values() for p in ps}))
+                succeeded = {label for label, ps in paths.items() if ps and not invalid.intersection(ps)}
+            except (OSError, subprocess.CalledProcessError):
+                succeeded = set()
+        link_results([(label, b) for label, b in builds if label in succeeded], cwd)
+        attributable = keep_going or len(builds) - len(succeeded) == 1
+        return [BuildResult(label, command, 'ok', build_duration(b, activities), log) if label in succeeded else
+                BuildResult(label, command, 'failed', build_duration(b, activities), log,
+                            returncode if attributable else None)
+                for label, b in builds]
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return [result for results in executor.map(run, tasks) for result in results]
+
+
+def show_summary(results):
+    """Print a table of the build results"""
+    colors = {'ok': 'green', 'cached': 'green', 'failed': 'red', 'broken': 'red', 'skipped': 'yellow'}
+    width = max(len(r.attr) for r in results)
+    click.secho('{}  {:7}  {:>9}'.format('attribute'.ljust(width), 'status', 'duration'), bold=True)
+    for r in results:
+        click.echo('{}  {}  {:>8.1f}s{}'.format(
+            r.attr.ljust(width),
+            click.style('{:7}'.format(r.status), fg=colors[r.status]),
+            r.duration,
+            '  (log: {})'.format(r.log) if r.failed and r.log else ''))
+    counts = {status: sum(r.status == status for r in results) for status in colors}
+    click.echo('{ok} succeeded, {failed} failed, {skipped} skipped, '
+               '{cached} already built, {broken} known to fail'.format(**counts))
+
+
+_store_path = re.compile(r'/nix/store/[^\s;]+')
+
+
+def out_paths(buildable):
+    """Out paths of the buildable, whose hash is its out paths (as listed by
+    nix-env) or its derivation. Empty when they can't be known."""
+    hash = str(buildable.hash)
+    if hash.endswith('.drv'):
+        try:
+            return list(read_drv(hash).outputs.values())
+        except (OSError, ValueError):
+            return []
+    return _store_path.findall(hash)
+
+
+def invalid_paths(paths, chunk_size=1000):
+    """The paths which are not valid in the store, checked in bulk"""
+    invalid = set()
+    for i in range(0, len(paths), chunk_size):
+        command = ['nix-store', '--check-validity', '--print-invalid'] + paths[i:i+chunk_size]
+        with trace.command_span(command, 'nix-store --check-validity'):
+            invalid.update(subprocess.check_output(command, universal_newlines=True).split())
+    return invalid
+
+
+class BuildRecord:
+    """Failed builds of each buildable, kept across reviews in sqlite
+
+    Failures are keyed by the hash of the buildable, its out paths or its
+    derivation, so they are only reused for the very same derivation, and
+    for failure_lifetime seconds, as a failure can come from a flaky build
+    or dependency. Only the failures of builders are kept, with a copy of
+    their log in log_dir if there is one.
+    """
+    failure_lifetime = 24 * 3600
+
+    def __init__(self, path=None, log_dir=None):
+        if path is None:
+            os.makedirs(cache_dir, exist_ok=True)
+            path = os.path.join(cache_dir, 'builds.sqlite')
+            log_dir = os.path.join(cache_dir, 'build-logs')
+        self.log_dir = log_dir
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS outcomes (key TEXT PRIMARY KEY, status TEXT, time REAL, log TEXT)')
+
+    def failures(self, keys, chunk_size=500):
+        """{key: log} of the given keys whose last build failed recently"""
+        keys = list(keys)
+        failures = {}
+        since = time.time() - self.failure_lifetime
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i+chunk_size]
+            failures.update(self.db.execute(
+                "SELECT key, log FROM outcomes WHERE status = 'failed' AND time > ? AND key IN ({})".format(
+                    ','.join('?' * len(chunk))), [since] + chunk))
+        return failures
+
+    def keep_log(self, key, log):
+        """Copy of the log of the build of key, which outlives the result
+        directory, or None"""
+        if not log or not self.log_dir:
+            return None
+        os.makedirs(self.log_dir, exist_ok=True)
+        kept = os.path.join(self.log_dir, hashlib.sha1(key.encode()).hexdigest() + '.log')
+        try:
+            shutil.copyfile(log, kept)
+        except OSError:
+            return None
+        return kept
+
+    def record(self, outcomes):
+        """Remember the (key, result) outcomes of builds which ran: a
+        success forgets an earlier failure"""
+        outcomes = [(str(key), r) for key, r in outcomes]
+        since = time.time() - self.failure_lifetime
+        with self.db:
+            self.db.executemany('DELETE FROM outcomes WHERE key = ?',
+                                ((key,) for key, r in outcomes if r.status == 'ok'))
+            self.db.executemany('INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?)',
+                                ((key, r.status, time.time(), self.keep_log(key, r.log))
+                                 for key, r in outcomes if r.builder_failed))
+            expired = self.db.execute('SELECT log FROM outcomes WHERE time <= ?', (since,)).fetchall()
+            self.db.execute('DELETE FROM outcomes WHERE time <= ?', (since,))
+        for log, in expired:
+            if log:
+                try:
+                    os.unlink(log)
+                except FileNotFoundError:
+                    pass
+
+
+def known_outcomes(buildables, record):
+    """{buildable: BuildResult} of the buildables which don't need building:
+    those whose out paths are all valid, and those which failed before"""
+    paths = {b: out_paths(b) for b in buildables}
+    try:
+        invalid = invalid_paths(sorted({p for ps in paths.values() for p in ps}))
+    except (OSError, subprocess.CalledProcessError):
+        # without nix-store, nothing is known to be built
+        invalid = None
+    failures = record.failures(str(b.hash) for b in buildables)
+
+    known = {}
+    for b in buildables:
+        if invalid is not None and paths[b] and not invalid.intersection(paths[b]):
+            known[b] = BuildResult(b.attr, None, 'cached')
+        elif str(b.hash) in failures:
+            known[b] = BuildResult(b.attr, None, 'broken', log=failures[str(b.hash)])
+    return known
@@ -1,8 +1,230 @@
 from dogpile.cache import make_region
-import getpass
+from dogpile.cache.api import CacheBackend, CachedValue, NO_VALUE
+from dogpile.cache.proxy import ProxyBackend
+from dogpile.cache.region import register_backend
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+
+from . import trace
+from .cachedir import expiration_time, cache_dir
+
+
+_types = {}
+
+
+def serializable(cls):
+    """class decorator allowing instances of cls in cached values
+
+    The instances are stored as their __dict__, and restored without calling
+    __init__.
+    """
+    _types['!' + cls.__name__] = cls
+    return cls
+
+
+def _encode_key(key):
+    if not isinstance(key, str):
+        raise TypeError('{!r} cannot be cached as a key'.format(key))
+    # keys starting with ! are escaped with another, so as not to be tags
+    return '!' + key if key.startswith('!') else key
+
+
+def _encode(obj):
+    if isinstance(obj, (str, int, float, bool)) or obj is None:
+        return obj
+    if isinstance(obj, list):
+        return [_encode(o) for o in obj]
+    if isinstance(obj, dict):
+        return {_encode_key(k): _encode(v) for k, v in obj.items()}
+    if isinstance(obj, tuple):
+        return {'!tuple': [_encode(o) for o in obj]}
+    if isinstance(obj, (set, frozenset)):
+        return {'!set': [_encode(o) for o in obj]}
+    tag = '!' + type(obj).__name__
+    if _types.get(tag) is type(obj):
+        return {tag: _encode(vars(obj))}
+    raise TypeError('{!r} cannot be cached'.format(obj))
+
+
+def _decode_object(obj):
+    if len(obj) == 1:
+        (tag, value), = obj.items()
+        if tag == '!tuple':
+            return tuple(value)
+        if tag == '!set':
+            return set(value)
+        if tag in _types:
+            cls = _types[tag]
+            instance = cls.__new__(cls)
+            instance.__dict__.update(value)
+            return instance
+    return {k[1:] if k.startswith('!') else k: v for k, v in obj.items()}
+
+
+def dumps(value):
+    """Compact serialization of a cached value: compressed, tagged json"""
+    return zlib.compress(json.dumps(_encode(value), separators=(',', ':')).encode())
+
+
+def loads(data):
+    return json.loads(zlib.decompress(data).decode(), object_hook=_decode_object)
+
+
+class FileMutex:
+    """dogpile mutex held with a lock file, so that it works across processes"""
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self, wait=True):
+        while True:
+            f = open(self.path, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            except BlockingIOError:
+                f.close()
+                return False
+            # the lock file may have been evicted while waiting for it
+            try:
+                if os.stat(self.path).st_ino == os.fstat(f.fileno()).st_ino:
+                    self.file = f
+                    return True
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    def release(self):
+        f, self.file = self.file, None
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+    def locked(self):
+        return self.file is not None
+
+
+class FileBackend(CacheBackend):
+    """dogpile backend storing each value in its own file
+
+    Values are written atomically, so any number of processes can use the
+    same directory. The least recently used values are evicted when the
+    directory grows over max_size bytes, along with their lock files.
+
+    arguments:
+        directory: where to store the values
+        max_size: size of the cache, in bytes
+    """
+    def __init__(self, arguments):
+        self.directory = arguments['directory']
+        self.max_size = arguments.get('max_size', 1024**3)
+        self.lock_dir = os.path.join(self.directory, 'locks')
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get_mutex(self, key):
+        return FileMutex(os.path.join(self.lock_dir, os.path.basename(self._path(key))))
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # the modification time is the last use, for the eviction
+            os.utime(path)
+            payload, metadata = loads(data)
+        except (OSError, ValueError, zlib.error):
+            return NO_VALUE
+        return CachedValue(payload, metadata)
+
+    def get_multi(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(dumps([value.payload, value.metadata]))
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.evict()
+
+    def set_multi(self, mapping):
+        for key, value in mapping.items():
+            self.set(key, value)
+
+    def delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def evict(self):
+        """Remove the least recently used values until the cache fits in max_size"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith('.'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(e[1] for e in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self.evict_locks()
+
+    def evict_locks(self):
+        """Remove the lock files of the values which are not cached, unless
+        they are held"""
+        for entry in os.scandir(self.lock_dir):
+            if os.path.exists(os.path.join(self.directory, entry.name)):
+                continue
+            mutex = FileMutex(entry.path)
+            if mutex.acquire(wait=False):
+                try:
+                    os.unlink(entry.path)
+                finally:
+                    mutex.release()
+
+
+class TracingProxy(ProxyBackend):
+    """Records a trace span for each value read or written"""
+    def get(self, key):
+        with trace.span('cache get', 'cache', key=key) as span:
+            value = self.proxied.get(key)
+            span['hit'] = value is not NO_VALUE
+            return value
+
+    def set(self, key, value):
+        with trace.span('cache set', 'cache', key=key):
+            self.proxied.set(key, value)
+
+
+register_backend('nox.file', 'nox.cache', 'FileBackend')
 
 region = make_region().configure(
-    'dogpile.cache.dbm',
-    expiration_time=36000,
-    arguments={'filename': '/tmp/nox.dbm.'+getpass.getuser()}
+    'nox.file',
+    expiration_time=expiration_time,
+    arguments={
+        'directory': os.path.join(cache_dir, 'region'),
+        'max_size': int(os.environ.get('NOX_CACHE_SIZE', 1024**3)),
+    },
+    wrap=[TracingProxy],
 )
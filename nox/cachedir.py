@@ -0,0 +1,34 @@
+"""Where nox keeps its caches and how long they last
+
+This module is cheap to import: the commands which don't need the cache
+region (nox itself) only import this, not the region in nox.cache.
+"""
+from contextlib import contextmanager
+import fcntl
+import os
+
+expiration_time = 36000
+
+cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'nox')
+
+index_dir = os.path.join(cache_dir, 'index')
+
+
+@contextmanager
+def file_lock(path, blocking=True, shared=False):
+    """Hold an exclusive lock on path, shared by all processes
+
+    Yields whether the lock was acquired, which is only False when not
+    blocking and another process holds it. A shared lock can be held by
+    several holders at once, but not together with an exclusive one.
+    """
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
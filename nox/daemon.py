@@ -0,0 +1,271 @@
+"""Optional per-user server keeping what nox computes in memory
+
+The commands ask the daemon first and do the work themselves when it isn't
+running. Requests and responses are json objects, one per line, on a Unix
+socket only accessible to the user:
+
+    {"method": "search", "params": {"queries": ["hello"]}}
+    {"result": [["nixpkgs.hello", "hello-2.10", "A program that ..."]]}
+
+The methods yielding their results stream them in chunks, as they are
+found, followed by an empty result:
+
+    {"method": "changes", "params": {"current": "/nix/store/...", ...}}
+    {"items": [[null, "/nix/store/...", "version", ...], ...]}
+    {"result": null}
+"""
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+import types
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import click
+
+from .cachedir import cache_dir, file_lock
+
+
+# seconds to wait for the daemon to accept a connection, then to answer,
+# which can take as long as evaluating nixpkgs: past that, the call fails
+# rather than doing the work again
+connect_timeout = 1
+answer_timeout = 600
+
+
+class Unavailable(Exception):
+    """The daemon isn't running: the caller does the work itself"""
+
+
+class Failed(click.ClickException):
+    """The daemon accepted the request, but failed to answer it: the work
+    is not done again while the daemon may still be doing it"""
+    def __init__(self, message):
+        super().__init__('The nox daemon failed: {}'.format(message))
+
+
+def socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or cache_dir
+    return os.path.join(runtime_dir, 'nox.sock')
+
+
+@contextmanager
+def _responses(method, params):
+    """Iterator over the responses of the daemon to the request"""
+    if os.environ.get('NOX_NO_DAEMON'):
+        raise Unavailable()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.settimeout(connect_timeout)
+            s.connect(socket_path())
+        except OSError as e:
+            raise Unavailable() from e
+        s.settimeout(answer_timeout)
+        try:
+            with s.makefile('rw') as f:
+                f.write(json.dumps({'method': method, 'params': params}) + '\n')
+                f.flush()
+                yield _read(f)
+        except OSError as e:
+            raise Failed(e) from e
+
+
+def _read(f):
+    while True:
+        line = f.readline()
+        if not line:
+            raise Failed('it stopped before answering')
+        try:
+            response = json.loads(line)
+        except ValueError as e:
+            raise Failed(e) from e
+        if 'error' in response:
+            raise Failed(response['error'])
+        yield response
+
+
+def call(method, **params):
+    """Result of the method, as computed by the daemon"""
+    with _responses(method, params) as responses:
+        return next(responses)['result']
+
+
+def stream(method, **params):
+    """Items of the result of the method, as streamed by the daemon"""
+    with _responses(method, params) as responses:
+        for response in responses:
+            if 'result' in response:
+                return
+            yield from response['items']
+
+
+class LRU:
+    """The last size results, by key"""
+    def __init__(self, size):
+        self.size = size
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        # locks of the keys being computed
+        self.computing = {}
+
+    def get(self, key, compute):
+        """The result for key, computed by compute() if it isn't known
+
+        Concurrent calls for the same key wait for the first one to compute
+        it.
+        """
+        with self.lock:
+            key_lock = self.computing.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                with self.lock:
+                    if key in self.results:
+                        self.results.move_to_end(key)
+                        return self.results[key]
+                result = compute()
+                with self.lock:
+                    self.results[key] = result
+                    while len(self.results) > self.size:
+                        self.results.popitem(last=False)
+                return result
+        finally:
+            with self.lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self.computing[key]
+
+
+class Methods:
+    """What the daemon answers, keeping the results it can reuse
+
+    Only the methods listed in rpc can be called. What is kept is bounded:
+    the results for the last few commits, and at most max_drvs derivations.
+    """
+    rpc = ('search', 'packages_for_sha', 'changes')
+    max_drvs = 500000
+
+    def __init__(self):
+        self.indexes = {}
+        self.indexes_lock = threading.Lock()
+        self.packages = LRU(8)
+        # the derivation graph is shared, and cleared when too large
+        self.graph_lock = threading.Lock()
+
+    def search(self, queries):
+        from .search import all_packages
+        with self.indexes_lock:
+            indexes = all_packages(opened=self.indexes)
+        return [list(p) for index in indexes if index is not None for p in index.search(queries)]
+
+    def packages_for_sha(self, sha, shards=1):
+        from .nixpkgs_repo import packages_for_sha
+        return self.packages.get((sha, shards), lambda: [
+            [b.attr, b.hash] for b in packages_for_sha(sha, shards=shards)])
+
+    def changes(self, current, new, max_level=0):
+        """Yield the changes from the current to the new system derivation,
+        as encoded by update.encode_change"""
+        from .update import NixPath, encode_change, graph, iter_changes
+
+        with self.graph_lock:
+            try:
+                for change in iter_changes(NixPath(current), NixPath(new), {'max_level': max_level}):
+                    yield encode_change(*change)
+            finally:
+                if len(graph.refs) > self.max_drvs:
+                    graph.clear()
+
+
+class Handler(socketserver.StreamRequestHandler):
+    # items streamed in each response
+    chunk_size = 1000
+
+    def handle(self):
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line.decode())
+                    if request['method'] not in Methods.rpc:
+                        raise AttributeError('no method {!r}'.format(request['method']))
+                    method = getattr(self.server.methods, request['method'])
+                    result = method(**request.get('params', {}))
+                    if isinstance(result, types.GeneratorType):
+                        self.stream(result)
+                        result = None
+                    response = {'result': result}
+                except Exception as e:
+                    response = {'error': '{}: {}'.format(type(e).__name__, e)}
+                self.respond(response)
+        except ConnectionError:
+            # the client gave up waiting
+            pass
+
+    def stream(self, items):
+        try:
+            chunk = []
+            for item in items:
+                chunk.append(item)
+                if len(chunk) == self.chunk_size:
+                    self.respond({'items': chunk})
+                    chunk = []
+            if chunk:
+                self.respond({'items': chunk})
+        finally:
+            # when the client went away
+            items.close()
+
+    def respond(self, response):
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+        self.wfile.flush()
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.methods = Methods()
+        super().__init__(path, Handler)
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+@click.command()
+@click.option('--socket', 'path', type=click.Path(dir_okay=False), default=socket_path, show_default=True,
+              help='Where to listen')
+def main(path):
+    """Serve nox requests from memory, until interrupted"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with file_lock(path + '.lock', blocking=False) as locked:
+        if not locked:
+            raise click.ClickException('Another daemon is listening on {}'.format(path))
+        if os.path.exists(path):
+            # left by a daemon which didn't stop cleanly
+            os.unlink(path)
+        # evaluate nixpkgs without the user's config, like nox-review does
+        os.environ['NIXPKGS_CONFIG'] = os.path.join(os.path.dirname(__file__), 'empty_config.nix')
+        # not in a checkout the nixpkgs repo would fetch
+        os.chdir(os.path.dirname(path))
+        old_umask = os.umask(0o077)
+        try:
+            server = Server(path)
+        finally:
+            os.umask(old_umask)
+        click.echo('Listening on {}'.format(path))
+        signal.signal(signal.SIGTERM, _interrupt)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
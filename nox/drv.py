@@ -0,0 +1,74 @@
+import collections
+import re
+
+
+Derivation = collections.namedtuple('Derivation', 'outputs input_drvs input_srcs system builder args env')
+Derivation.__doc__ = """Contents of a .drv file
+
+outputs: {output name: output path}
+input_drvs: {derivation path: [output names]}
+input_srcs: [source path]
+env: {variable: value}
+"""
+
+_token = re.compile(r'"((?:[^"\\]|\\.)*)"|([\[\]\(\),])|(\w+)|(\S)', re.DOTALL)
+_escape = re.compile(r'\\(.)', re.DOTALL)
+_escapes = {'n': '\n', 'r': '\r', 't': '\t'}
+
+
+def _unescape(s):
+    if '\\' not in s:
+        return s
+    return _escape.sub(lambda m: _escapes.get(m.group(1), m.group(1)), s)
+
+
+def parse_aterm(text):
+    """Parse the ATerm subset used by .drv files: a constructor applied to
+    strings, lists and tuples. Lists are returned as lists, tuples as tuples,
+    and the constructor application as (name, arguments)."""
+    stack = [[]]
+    # the punctuation closing each list or tuple of the stack
+    closing = []
+    constructor = None
+    for m in _token.finditer(text):
+        string, punct, word, other = m.groups()
+        if string is not None:
+            stack[-1].append(_unescape(string))
+        elif punct in ('[', '('):
+            stack.append([])
+            closing.append(']' if punct == '[' else ')')
+        elif closing and punct == closing[-1]:
+            closing.pop()
+            items = stack.pop()
+            stack[-1].append(items if punct == ']' else tuple(items))
+        elif punct == ',':
+            pass
+        elif word is not None and constructor is None and len(stack) == 1:
+            constructor = word
+        else:
+            raise ValueError('Unexpected {!r} at {} in derivation'.format(m.group(), m.start()))
+    if len(stack) != 1 or len(stack[0]) != 1 or constructor is None:
+        raise ValueError('Truncated derivation')
+    return constructor, stack[0][0]
+
+
+def parse_drv(text):
+    """Parse the contents of a .drv file"""
+    constructor, args = parse_aterm(text)
+    if constructor != 'Derive' or len(args) != 7:
+        raise ValueError('Unsupported derivation format {!r}'.format(constructor))
+    outputs, input_drvs, input_srcs, system, builder, builder_args, env = args
+    return Derivation(
+        outputs={output[0]: output[1] for output in outputs},
+        input_drvs={drv: list(names) for drv, names in input_drvs},
+        input_srcs=list(input_srcs),
+        system=system,
+        builder=builder,
+        args=list(builder_args),
+        env=dict(env))
+
+
+def read_drv(path):
+    """Parse the .drv file at path"""
+    with open(path) as f:
+        return parse_drv(f.read())
@@ -0,0 +1,2 @@
+# nixpkgs config without any of the settings of the user
+pkgs: {}
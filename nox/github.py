@@ -0,0 +1,48 @@
+import requests
+from dogpile.cache.api import NO_VALUE
+
+from .cache import region
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class GitHub:
+    """Client of the GitHub API, remembering the payloads it got
+
+    All requests share one HTTP session. Payloads are cached with their
+    ETag, and requested again conditionally: an unchanged payload costs a
+    304 response, which GitHub doesn't count in the rate limit.
+    """
+    def __init__(self, token=None, api_url='https://api.github.com', cache=region):
+        self.api_url = api_url.rstrip('/')
+        self.cache = cache
+        self.session = requests.Session()
+        self.session.headers['Accept'] = 'application/vnd.github.v3+json'
+        if token:
+            self.session.headers['Authorization'] = 'token {}'.format(token)
+
+    def get(self, url):
+        """Decoded json at url, which may be relative to the API root"""
+        if url.startswith('/'):
+            url = self.api_url + url
+        key = 'github:{}'.format(url)
+        cached = self.cache.get(key, ignore_expiration=True)
+        headers = {}
+        if cached is not NO_VALUE:
+            headers['If-None-Match'] = cached['etag']
+
+        response = self.session.get(url, headers=headers)
+        if response.status_code == 304 and cached is not NO_VALUE:
+            return cached['payload']
+        if response.status_code == 403 and response.headers.get('X-RateLimit-Remaining') == '0':
+            raise RateLimitExceeded()
+        response.raise_for_status()
+        payload = response.json()
+        if 'ETag' in response.headers:
+            self.cache.set(key, {'etag': response.headers['ETag'], 'payload': payload})
+        return payload
+
+    def pull_request(self, slug, pr):
+        return self.get('/repos/{}/pulls/{}'.format(slug, pr))
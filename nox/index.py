@@ -0,0 +1,156 @@
+import os
+import re
+import time
+import sqlite3
+import tempfile
+import collections
+from array import array
+from collections import defaultdict
+from urllib.parse import quote
+
+
+Package = collections.namedtuple('Package', 'attribute name description')
+
+_regex_special = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+
+def trigrams(s):
+    """Set of the lowercased 3-character substrings of s"""
+    s = s.lower()
+    return {s[i:i+3] for i in range(len(s) - 2)}
+
+
+def query_trigrams(query):
+    """Trigrams that every string matching the query must contain.
+
+    Returns None when the query cannot be answered from the index (regex
+    syntax, non-ascii characters, or shorter than a trigram), in which case
+    the candidates have to be scanned.
+    """
+    if len(query) < 3 or not query.isascii() or _regex_special.search(query):
+        return None
+    return trigrams(query)
+
+
+def matches(package, patterns):
+    """True if one of the fields of the package matches all the patterns"""
+    return any(all(pat.search(s) for pat in patterns) for s in package)
+
+
+class PackageIndex:
+    """Packages listed by nix-env, with a trigram index over all their fields
+
+    The index is a sqlite file holding the packages and, for each trigram,
+    the sorted ids of the packages containing it. It is built once when the
+    cache is refreshed, then literal queries only look at the packages
+    containing all their trigrams instead of scanning everything.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect('file:{}?mode=ro'.format(quote(path)), uri=True,
+                                  check_same_thread=False)
+        try:
+            meta = dict(self.db.execute('SELECT name, value FROM meta'))
+            self.key = meta['key']
+            self.created = float(meta['created'])
+        except BaseException:
+            self.db.close()
+            raise
+
+    @classmethod
+    def open(cls, path):
+        """Open the index at path, or return None if there is no usable one"""
+        try:
+            return cls(path)
+        except (sqlite3.Error, KeyError, ValueError):
+            return None
+
+    @property
+    def age(self):
+        return time.time() - self.created
+
+    @classmethod
+    def build(cls, path, key, packages):
+        """Write the packages to a new index at path, and open it
+
+        The index is written next to its destination and moved in place
+        once complete, so readers never see a partial index.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        prefix=os.path.basename(path) + '.')
+        os.close(fd)
+        try:
+            db = sqlite3.connect(tmp_path)
+            db.executescript("""
+                CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE packages (id INTEGER PRIMARY KEY,
+                                       attribute TEXT, name TEXT, description TEXT);
+                CREATE TABLE trigrams (trigram TEXT PRIMARY KEY, ids BLOB);
+            """)
+            postings = defaultdict(lambda: array('I'))
+
+            def rows():
+                for i, package in enumerate(packages):
+                    for trigram in set().union(*map(trigrams, package)):
+                        postings[trigram].append(i)
+                    yield (i,) + tuple(package)
+
+            db.executemany('INSERT INTO packages VALUES (?, ?, ?, ?)', rows())
+            db.executemany('INSERT INTO trigrams VALUES (?, ?)',
+                           ((t, ids.tobytes()) for t, ids in postings.items()))
+            db.executemany('INSERT INTO meta VALUES (?, ?)',
+                           [('key', key), ('created', repr(time.time()))])
+            db.commit()
+            db.close()
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return cls(path)
+
+    def __iter__(self):
+        for row in self.db.execute('SELECT attribute, name, description FROM packages ORDER BY id'):
+            yield Package(*row)
+
+    def _postings(self, trigram):
+        row = self.db.execute('SELECT ids FROM trigrams WHERE trigram = ?', (trigram,)).fetchone()
+        ids = array('I')
+        if row:
+            ids.frombytes(row[0])
+        return ids
+
+    def candidates(self, grams):
+        """Ids of the packages containing all the given trigrams"""
+        result = None
+        for ids in sorted(map(self._postings, grams), key=len):
+            result = set(ids) if result is None else result.intersection(ids)
+            if not result:
+                break
+        return result
+
+    def _packages(self, ids):
+        ids = sorted(ids)
+        # stay below sqlite's limit on the number of parameters
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i+500]
+            query = 'SELECT attribute, name, description FROM packages WHERE id IN ({})'
+            for row in self.db.execute(query.format(','.join('?' * len(chunk))), chunk):
+                yield Package(*row)
+
+    def search(self, queries):
+        """List the packages with a field matching all the queries
+
+        Queries are case-insensitive regular expressions. Those which are
+        plain strings narrow down the candidates through the index, and the
+        candidates are then checked against all the queries.
+        """
+        patterns = [re.compile(query, re.IGNORECASE) for query in queries]
+        candidates = None
+        for query in queries:
+            grams = query_trigrams(query)
+            if grams is None:
+                continue
+            ids = self.candidates(grams)
+            candidates = ids if candidates is None else candidates & ids
+        packages = iter(self) if candidates is None else self._packages(candidates)
+        return [p for p in packages if matches(p, patterns)]
@@ -0,0 +1,18 @@
+# small utility to get the derivations of some nixos tests, listed by
+# list_tests.nix, as [ { attr = "tests.foo"; drv = drvPath or null; } ]
+# the drv is null when the test doesn't evaluate
+{ attrsJSON }:
+let
+  tests = (import <nixpkgs/nixos/release.nix> {
+    supportedSystems = [ builtins.currentSystem ];
+  }).tests;
+  lib = (import <nixpkgs/lib>);
+  instantiate = attr:
+  let
+    # drop the leading "tests"
+    path = lib.tail (lib.splitString "." attr);
+    drv = builtins.tryEval (lib.getAttrFromPath path tests).${builtins.currentSystem}.drvPath;
+  in
+    { inherit attr; drv = if drv.success then drv.value else null; };
+in
+  map instantiate (builtins.fromJSON attrsJSON)
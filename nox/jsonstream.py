@@ -0,0 +1,73 @@
+import json
+import re
+
+_whitespace = re.compile(r'\s*')
+
+
+class _Reader:
+    """Buffer over a text stream, only keeping what has not been parsed yet"""
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """Next non-whitespace character, or '' at the end of the stream"""
+        while True:
+            self.pos = _whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos+1]
+            self.fill()
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('Expected {!r} but found {!r}'.format(char, found))
+        self.pos += 1
+
+    def value(self, decoder):
+        """Decode the next JSON value, reading as much as needed"""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+            else:
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            self.fill()
+
+
+def iter_object_items(stream, chunk_size=1 << 16):
+    """Lazily yield the (key, value) pairs of the JSON object read from stream
+
+    Only the item being decoded is held in memory, so this can process the
+    output of a command as it is produced, whatever its size.
+    """
+    decoder = json.JSONDecoder()
+    reader = _Reader(stream, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value(decoder)
+        if not isinstance(key, str):
+            raise ValueError('Expected an object key but found {!r}'.format(key))
+        reader.expect(':')
+        yield key, reader.value(decoder)
+        if reader.peek() == '}':
+            return
+        reader.expect(',')
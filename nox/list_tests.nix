@@ -0,0 +1,23 @@
+# small utility to list the attribute names of all nixos tests
+# it doesn't evaluate the tests themselves, only the structure of the
+# tests attribute set, so it's much cheaper than instantiating them
+{ disable_blacklist ? false }:
+let
+  tests = (import <nixpkgs/nixos/release.nix> {
+    supportedSystems = [ builtins.currentSystem ];
+  }).tests;
+  lib = (import <nixpkgs/lib>);
+  blacklist = if disable_blacklist then [] else
+    # list of patterns of tests to never rebuild
+    # they depend on ./. so are rebuilt on each commit
+    [ "installer" "containers-.*" "initrd-network-ssh" "boot" "ec2-.*" ];
+  enumerate = prefix: name: value:
+  # an attr in tests is either { x86_64 = derivation; } or an attrset of such values.
+  if lib.any (x: builtins.match x name != null) blacklist then [] else
+  if lib.hasAttr builtins.currentSystem value then
+    [ "${prefix}${name}" ]
+  else
+    lib.concatLists (lib.mapAttrsToList (enumerate (prefix + name + ".")) value);
+in
+  # list of "tests.foo"
+  enumerate "" "tests" tests
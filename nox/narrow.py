@@ -0,0 +1,110 @@
+import os
+import subprocess
+from collections import defaultdict
+from fnmatch import fnmatch
+
+import click
+from dogpile.cache.api import NO_VALUE
+
+from .cache import region
+from .nixpkgs_repo import get_repo, attribute_index_for_sha
+
+
+# files on which too many packages depend to narrow anything down
+core_files = ['lib/*', 'default.nix', 'pkgs/top-level/*', 'pkgs/stdenv/*',
+              'pkgs/build-support/*', 'pkgs/os-specific/*/stdenv/*']
+
+# files which don't change any package
+ignored_files = ['nixos/*', 'doc/*', 'maintainers/*', '.github/*', '*.md']
+
+# past this many, the attributes don't fit on the nix-env command line and
+# listing them is hardly faster than listing everything
+max_attributes = 2000
+
+# the attribute index is only used to guess which packages may have changed,
+# so an index built for an older commit is good enough for a while
+attribute_index_max_age = 7*24*3600
+
+
+def attribute_index(sha, shards=1):
+    """The last attribute index built, or a new one for sha if it's too old"""
+    index = region.get('attribute-index', expiration_time=attribute_index_max_age)
+    if index is NO_VALUE:
+        click.echo('==> Indexing where the packages are defined')
+        index = attribute_index_for_sha(sha, shards=shards)
+        region.set('attribute-index', index)
+    return index
+
+
+def changed_files(old_sha, new_sha):
+    """Files changed between the two shas, or since old_sha in the current dir"""
+    if new_sha is None:
+        changed = subprocess.check_output(['git', 'diff', '--name-only', old_sha],
+                                          universal_newlines=True)
+        changed += subprocess.check_output(['git', 'ls-files', '--others', '--exclude-standard'],
+                                           universal_newlines=True)
+    else:
+        changed = get_repo().git(['diff', '--name-only', old_sha, new_sha], output=True)
+    return changed.splitlines()
+
+
+def affected_attributes(index, files, chunk_size=1000):
+    """Attributes whose derivation may change with the given files
+
+    The packages defined in the directory of a changed file (or in the
+    closest parent directory defining some) are affected, as well as every
+    package depending on them. Returns None when this can't be known.
+    """
+    directories = defaultdict(set)
+    for file, attrs in index['files'].items():
+        directories[os.path.dirname(file)].update(attrs)
+
+    changed = set()
+    for file in files:
+        if any(fnmatch(file, pattern) for pattern in core_files):
+            click.echo('==> {} changed, every package may be affected'.format(file))
+            return None
+        if any(fnmatch(file, pattern) for pattern in ignored_files):
+            continue
+        directory = os.path.dirname(file)
+        while directory not in directories:
+            if not directory:
+                click.echo('==> No package is defined near {}'.format(file))
+                return None
+            directory = os.path.dirname(directory)
+        changed |= directories[directory]
+
+    drvs = {index['drvs'][attr] for attr in changed if attr in index['drvs']}
+    if not drvs:
+        return changed
+    drvs = sorted(drvs)
+    referrers = []
+    try:
+        # the derivations of the index are still in the store, unless
+        # collected. They are queried in chunks fitting on a command line.
+        for i in range(0, len(drvs), chunk_size):
+            referrers += subprocess.check_output(['nix-store', '--query', '--referrers-closure'] +
+                                                 drvs[i:i+chunk_size], universal_newlines=True).split()
+    except subprocess.CalledProcessError:
+        return None
+
+    attrs_of_drv = defaultdict(set)
+    for attr, drv in index['drvs'].items():
+        attrs_of_drv[drv].add(attr)
+    return changed.union(*(attrs_of_drv[drv] for drv in referrers))
+
+
+def narrowed_attributes(old_sha, new_sha, shards=1):
+    """Top-level attributes whose packages may differ between the two shas
+
+    Returns None when all the packages have to be compared.
+    """
+    affected = affected_attributes(attribute_index(old_sha, shards), changed_files(old_sha, new_sha))
+    if affected is None:
+        return None
+    attrs = {attr.split('.', 1)[0] for attr in affected}
+    if len(attrs) > max_attributes:
+        click.echo('==> {} top-level attributes may be affected, listing all packages'.format(len(attrs)))
+        return None
+    click.echo('==> Only listing the packages under {} top-level attributes'.format(len(attrs)))
+    return attrs
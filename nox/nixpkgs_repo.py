@@ -1,30 +1,48 @@
+import functools
+import inspect
 import os
+import shutil
 import subprocess
 import json
+import threading
 from pathlib import Path
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from fnmatch import fnmatch
 
-from .cache import region
+from . import trace
+from .cache import region, serializable
+from .cachedir import file_lock
+from dogpile.cache.api import NO_VALUE
+from .jsonstream import iter_object_items
+from .remote_cache import remote_cached
+from dogpile.cache.util import function_key_generator
 
 import click
-import psutil
 
 
 class Repo:
-    def __init__(self):
+    # checkouts of other commits kept around, see worktree()
+    max_worktrees = 4
+
+    def __init__(self, path=None, remote='https://github.com/NixOS/nixpkgs.git', cache=region):
         nox_dir = Path(click.get_app_dir('nox', force_posix=True))
-        if not nox_dir.exists():
-            nox_dir.mkdir()
+        if path is None:
+            if not nox_dir.exists():
+                nox_dir.mkdir()
+            path = nox_dir / 'nixpkgs'
 
-        nixpkgs = nox_dir / 'nixpkgs'
+        nixpkgs = Path(path)
         self.path = str(nixpkgs)
+        self.remote = remote
+        self.cache = cache
+        self.worktrees = nixpkgs.parent / 'worktrees'
 
         if not nixpkgs.exists():
             click.echo('==> Creating nixpkgs repo in {}'.format(nixpkgs))
             self.git(['init', '--quiet', self.path], cwd=False)
-            self.git('remote add origin https://github.com/NixOS/nixpkgs.git')
+            self.git(['remote', 'add', 'origin', remote])
             self.git('config user.email nox@example.com')
             self.git('config user.name nox')
 
@@ -47,14 +65,80 @@ class Repo:
             cwd = None
         if isinstance(command, str):
             command = command.split()
+        name = 'git ' + command[0]
         # suppress gpg prompt when git command tries to create/modify commit
         command = ['git', '-c', 'commit.gpgSign=false'] + command
         f = subprocess.check_output if output else subprocess.check_call
-        return f(command, *args, cwd=cwd, universal_newlines=output, **kwargs)
+        with trace.command_span(command, name):
+            return f(command, *args, cwd=cwd, universal_newlines=output, **kwargs)
 
     def checkout(self, sha):
         self.git(['checkout', '-f', '--quiet', sha])
 
+    @contextmanager
+    def worktree(self, sha):
+        """Context manager giving the path of a working tree checked out at sha
+
+        Each commit gets its own working tree, so that several commits can be
+        evaluated at the same time. A working tree is in use until the block
+        ends, which every nox process knows from a shared lock on
+        <worktree>.lock. The least recently used ones which are not in use
+        are removed once there are more than max_worktrees of them.
+        """
+        path = self.worktrees / sha
+        self.worktrees.mkdir(exist_ok=True)
+        with ExitStack() as in_use:
+            with file_lock(str(self.worktrees / '.lock')):
+                in_use.enter_context(file_lock(str(path) + '.lock', shared=True))
+                if not path.exists():
+                    self.git('worktree prune')
+                    self.git(['worktree', 'add', '--detach', '--force', str(path), sha],
+                             stdout=subprocess.DEVNULL)
+                    self._remove_old_worktrees()
+                os.utime(str(path))
+            yield str(path)
+        with file_lock(str(self.worktrees / '.lock')):
+            self._remove_old_worktrees()
+
+    def _remove_old_worktrees(self):
+        """Remove the least recently used working trees not in use, while
+        holding the lock of the worktrees directory"""
+        worktrees = sorted((p for p in self.worktrees.iterdir() if p.is_dir() and not p.name.startswith('.')),
+                           key=lambda p: p.stat().st_mtime)
+        removed = False
+        for path in worktrees[:-self.max_worktrees]:
+            lock = str(path) + '.lock'
+            with file_lock(lock, blocking=False) as unused:
+                if unused:
+                    shutil.rmtree(str(path))
+                    # only opened while holding the lock of the directory
+                    os.unlink(lock)
+                    removed = True
+        if removed:
+            self.git('worktree prune')
+
+    def merge(self, base, head, message='Nox automatic merge'):
+        """Merge head into base, and return the sha of the merge commit
+
+        The merge is done in a working tree of its own, .merge, so that it
+        doesn't disturb the working trees being evaluated meanwhile.
+        """
+        path = self.worktrees / '.merge'
+        self.worktrees.mkdir(exist_ok=True)
+        with file_lock(str(path) + '.lock'):
+            if not path.exists():
+                with file_lock(str(self.worktrees / '.lock')):
+                    self.git('worktree prune')
+                    self.git(['worktree', 'add', '--detach', '--force', str(path), base],
+                             stdout=subprocess.DEVNULL)
+            self.git(['checkout', '-f', '--quiet', '--detach', base], cwd=str(path))
+            try:
+                self.git(['merge', head, '--no-ff', '-qm', message], cwd=str(path))
+            except subprocess.CalledProcessError:
+                self.git(['merge', '--abort'], cwd=str(path))
+                raise
+            return self.git(['rev-parse', '--verify', 'HEAD'], cwd=str(path), output=True).strip()
+
     def sha(self, ref):
         return self.git(['rev-parse', '--verify', ref], output=True).strip()
 
@@ -68,17 +152,42 @@ class Repo:
         except subprocess.CalledProcessError:
             return None
 
+    def fetch_merge_history(self, base_ref, head_ref, base, head):
+        """Fetch enough history of the base and head refs to merge them
+
+        The depth that was needed is remembered for the base ref, and fetched
+        right away the next time.
+        """
+        key = 'merge-depth:{}:{}'.format(self.remote, base_ref)
+        depth = self.cache.get(key, ignore_expiration=True)
+        if depth is NO_VALUE:
+            depth = 10
+        needed = None
+        while not self.merge_base(head, base):
+            self.fetch(base_ref, depth=depth)
+            self.fetch(head_ref, depth=depth)
+            needed = depth
+            depth *= 2
+        if needed:
+            self.cache.set(key, needed)
+
+        # It looks like this isn't enough for a merge, so we fetch more
+        self.fetch(base_ref, depth=depth)
+
 
 _repo = None
+_repo_lock = threading.Lock()
 
 
 def get_repo():
     global _repo
-    if not _repo:
-        _repo = Repo()
+    with _repo_lock:
+        if not _repo:
+            _repo = Repo()
     return _repo
 
 
+@serializable
 class Buildable:
     """
     attr (str): attribute name under which the buildable can be built
@@ -98,6 +207,11 @@ class Buildable:
     def __hash__(self):
         return hash(self.hash)
 
+    @property
+    def kind(self):
+        """'package', or 'test' for the buildables of the NixOS tests"""
+        return 'package' if self.path == '<nixpkgs>' else 'test'
+
     @property
     def path_args(self):
         if isinstance(self.path, str):
@@ -125,72 +239,222 @@ def at_given_sha(f):
 
     Turns a function path -> 'a into a function sha -> 'a.
     If the sha passed is None, passes the current directory as argument.
+    Each sha has its own working tree, so calls for different shas can run
+    concurrently.
     """
+    @functools.wraps(f)
     def _wrapped(sha, *args, **kwargs):
-        if sha is not None:
-            repo = get_repo()
-            repo.checkout(sha)
-            path = repo.path
-        else:
-            path = os.getcwd()
-        return f(path, *args, **kwargs)
-    _wrapped.__name__ = f.__name__
+        if sha is None:
+            return f(os.getcwd(), *args, **kwargs)
+        with get_repo().worktree(sha) as path:
+            return f(path, *args, **kwargs)
     return _wrapped
 
 
+def key_ignoring(*ignored):
+    """dogpile key generator for functions whose ignored arguments only tune
+    how the result is computed, and so are not part of the key
+
+    The other arguments are, with their default values, however they are
+    passed.
+    """
+    def key_generator(namespace, fn):
+        signature = inspect.signature(fn)
+        generate_key = function_key_generator(namespace, fn)
+        def key(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return generate_key(*(value for name, value in bound.arguments.items() if name not in ignored))
+        return key
+    return key_generator
+
+
 def cache_on_not_None(f):
-    """like region.cache_on_argument() but does not cache if the key starts None"""
-    wf = region.cache_on_arguments()(f)
-    def _wrapped(arg, *args):
+    """like region.cache_on_argument() but does not cache if the key starts
+    None, nor depends on the number of shards"""
+    wf = region.cache_on_arguments(function_key_generator=key_ignoring('shards'))(f)
+    def _wrapped(arg, *args, **kwargs):
         if arg is None:
-            return f(arg, *args)
-        return wf(arg, *args)
+            return f(arg, *args, **kwargs)
+        return wf(arg, *args, **kwargs)
     _wrapped.__name__ = f.__name__
     return _wrapped
 
 
+def max_workers(job_memory):
+    """How many nix evaluations taking job_memory bytes can run at once"""
+    import psutil
+    workers = max(1, psutil.virtual_memory().available//job_memory)
+    # a job is also cpu hungry
+    try:
+        workers = min(workers, os.cpu_count())
+    except: pass
+    return workers
+
+
+_evaluation_slots = None
+_evaluation_slots_lock = threading.Lock()
+
+
+@contextmanager
+def evaluation_slot():
+    """Wait for a nix evaluation to be allowed to run
+
+    The evaluations of concurrent calls (for example for two commits) all
+    share the same limit, so that they fit in memory together.
+    """
+    global _evaluation_slots
+    with _evaluation_slots_lock:
+        if _evaluation_slots is None:
+            # the largest jobs take 1~1.7 GB mem
+            _evaluation_slots = threading.BoundedSemaphore(max_workers(1700*1024*1024))
+    with _evaluation_slots:
+        yield
+
+
+def evaluate(command):
+    """Output of the nix evaluation command"""
+    with evaluation_slot(), trace.command_span(command):
+        return subprocess.check_output(command, universal_newlines=True)
+
+
+shard_packages = str(Path(__file__).parent / "shard_packages.nix")
+
+
+def nix_env_command(path, shard=0, shards=1, attrs=None):
+    """nix-env invocation for the packages of the nixpkgs at path
+
+    With several shards, only 1/shards of the top-level attributes are
+    selected. attrs restricts the selection to the given top-level attributes.
+    """
+    if shards == 1 and attrs is None:
+        return ['nix-env', '-f', path]
+    command = ['nix-env', '-f', shard_packages, '--argstr', 'nixpkgs', str(path),
+        '--arg', 'shardIndex', str(shard), '--arg', 'numShards', str(shards)]
+    if attrs is not None:
+        command += ['--argstr', 'attrsJSON', json.dumps(sorted(attrs))]
+    return command
+
+
+def list_packages(path, shards=1, attrs=None):
+    """List the nix packages in the repo at path, as a set of buildables"""
+    def eval(i):
+        return evaluate(nix_env_command(path, i, shards, attrs) +
+            ['-qaP', '--out-path', '--show-trace'])
+
+    # at this size, a shard takes up to 1.5 GB mem
+    with ThreadPoolExecutor(max_workers=max_workers(1500*1024*1024)) as executor:
+        outputs = executor.map(eval, range(shards))
+
+    packages = set()
+    for output in outputs:
+        for line in output.splitlines():
+            attr, hash = line.split(" ", 1)
+            # columns are padded to the widest value of each nix-env process
+            packages.add(Buildable(attr, " ".join(hash.split())))
+    return packages
+
+
+@trace.traced
 @cache_on_not_None
+@remote_cached('packages')
 @at_given_sha
-def packages_for_sha(path):
-    """List all nix packages in the repo, as a set of buildables"""
-    output = subprocess.check_output(['nix-env', '-f', path, '-qaP',
-        '--out-path', '--show-trace'], universal_newlines=True)
-    return {Buildable(attr, hash) for attr, hash in
-            map(lambda line: line.split(" ", 1), output.splitlines())}
+def packages_for_sha(path, shards=1):
+    """List all nix packages in the repo, as a set of buildables
 
+    With several shards, the top-level attributes are split between as many
+    concurrent nix-env processes.
+    """
+    return list_packages(path, shards)
 
-enumerate_tests = str(Path(__file__).parent / "enumerate_tests.nix")
+
+@at_given_sha
+def packages_in_attrs_for_sha(path, attrs):
+    """List the nix packages under the given top-level attributes"""
+    return list_packages(path, attrs=attrs)
 
 
-@cache_on_not_None
 @at_given_sha
-def tests_for_sha(path, disable_blacklist=False):
-    """List all tests wich evaluate in the repo, as a set of (attr, drvPath)"""
-    num_jobs = 32
-    # at this size, each job takes 1~1.7 GB mem
-    max_workers = max(1, psutil.virtual_memory().available//(1700*1024*1024))
-    # a job is also cpu hungry
-    try:
-        max_workers = min(max_workers, os.cpu_count())
-    except: pass
+def attribute_index_for_sha(path, shards=1):
+    """Where the packages in the repo are defined, and their derivations
 
+    Returns {'drvs': {attr: drvPath}, 'files': {file: [attr]}}, the files
+    being relative to the root of the repo.
+    """
     def eval(i):
-        output = subprocess.check_output(['nix-instantiate', '--eval',
-            '--json', '--strict', '-I', "nixpkgs="+str(path), enumerate_tests,
-            '--arg', "jobIndex", str(i), '--arg', 'numJobs', str(num_jobs),
-            '--arg', 'disableBlacklist', str(disable_blacklist).lower(),
-            '--show-trace'], universal_newlines=True)
+        command = nix_env_command(path, i, shards) + ['-qaP', '--json', '--meta',
+            '--drv-path', '--show-trace']
+        drvs, files = {}, defaultdict(list)
+        truncated = None
+        with evaluation_slot(), trace.command_span(command) as span, subprocess.Popen(
+                command, stdout=subprocess.PIPE, universal_newlines=True) as process:
+            try:
+                for attr, info in iter_object_items(process.stdout):
+                    if 'drvPath' in info:
+                        drvs[attr] = info['drvPath']
+                    position = info.get('meta', {}).get('position', '')
+                    if position.startswith(str(path) + '/'):
+                        file = position[len(str(path)) + 1:].rsplit(':', 1)[0]
+                        files[file].append(attr)
+            except ValueError as e:
+                # the output of a failed evaluation stops short
+                truncated = e
+        span['exit_code'] = process.returncode
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command)
+        if truncated:
+            raise truncated
+        return drvs, files
+
+    with ThreadPoolExecutor(max_workers=max_workers(1500*1024*1024)) as executor:
+        evals = executor.map(eval, range(shards))
+
+    index = {'drvs': {}, 'files': defaultdict(list)}
+    for drvs, files in evals:
+        index['drvs'].update(drvs)
+        for file, attrs in files.items():
+            index['files'][file] += attrs
+    index['files'] = dict(index['files'])
+    return index
+
+
+list_tests = str(Path(__file__).parent / "list_tests.nix")
+instantiate_tests = str(Path(__file__).parent / "instantiate_tests.nix")
+
+
+def instantiate_tests_at(path, disable_blacklist=False):
+    """{test attribute: drvPath or None if it doesn't evaluate} of the tests
+    of the nixpkgs at path"""
+    nix_instantiate = ['nix-instantiate', '--eval', '--json', '--strict', '-I', "nixpkgs="+str(path)]
+    names = json.loads(evaluate(nix_instantiate + [list_tests,
+        '--arg', 'disable_blacklist', str(disable_blacklist).lower(), '--show-trace']))
+    if not names:
+        return {}
+
+    # each job imports release.nix again, and takes 1~1.7 GB mem
+    jobs = min(max_workers(1700*1024*1024), len(names))
+
+    def eval(i):
+        output = evaluate(nix_instantiate + [instantiate_tests,
+            '--argstr', 'attrsJSON', json.dumps(names[i::jobs]), '--show-trace'])
         return json.loads(output)
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        evals = executor.map(eval, range(num_jobs))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        evals = executor.map(eval, range(jobs))
 
-    path = ("<nixpkgs/nixos/release.nix>", "--arg", "supportedSystems", "[builtins.currentSystem]")
-    attrs = set()
-    for partial in evals:
-        for test in partial:
-            b = Buildable(test["attr"], test["drv"], path=path)
-            attrs.add(b)
+    return {test['attr']: test['drv'] for partial in evals for test in partial}
 
-    return attrs
 
+@trace.traced
+@cache_on_not_None
+@at_given_sha
+def tests_for_sha(path, disable_blacklist=False):
+    """List all tests wich evaluate in the repo, as a set of buildables
+
+    The names of the tests are listed once, then the tests are instantiated
+    by several nix-instantiate processes, each given its share of the names.
+    """
+    drvs = instantiate_tests_at(path, disable_blacklist)
+
+    path = ("<nixpkgs/nixos/release.nix>", "--arg", "supportedSystems", "[builtins.currentSystem]")
+    return {Buildable(attr, drv, path=path) for attr, drv in drvs.items() if drv is not None}
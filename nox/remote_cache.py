@@ -0,0 +1,144 @@
+"""Evaluation results shared between machines
+
+Results which only depend on a nixpkgs commit, like the packages it
+contains, can be shared by every reviewer and CI worker. NOX_REMOTE_CACHE
+points to where they are shared: a directory (for example on a network
+file system), or an http(s) URL where entries are read with GET and
+written with PUT.
+
+Entries are compressed, and prefixed by their sha256 so that a corrupted
+entry is ignored instead of being used. Their keys include format_version,
+to be increased whenever the format of the entries changes.
+"""
+import functools
+import hashlib
+import os
+import platform
+import sys
+import tempfile
+
+import click
+
+from .cache import dumps, loads
+
+format_version = 1
+
+
+class DirectoryStore:
+    """Entries stored as files under a directory, readable by whoever the
+    umask allows to, like files created by other programs"""
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.path, key), 'rb') as f:
+                return f.read()
+        except OSError:
+            # missing, or unreadable: the entry is written again
+            return None
+
+    def put(self, key, data):
+        path = os.path.join(self.path, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # mkstemp only lets the owner read the file
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class HttpStore:
+    """Entries read with GET and written with PUT under a base URL"""
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def get(self, key):
+        response = self.session.get('{}/{}'.format(self.url, key))
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.content
+
+    def put(self, key, data):
+        self.session.put('{}/{}'.format(self.url, key), data=data).raise_for_status()
+
+
+@functools.lru_cache()
+def store_for(url):
+    """The store at url, created once so that its connections are reused"""
+    if url.startswith(('http://', 'https://')):
+        return HttpStore(url)
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return DirectoryStore(url)
+
+
+def remote_store():
+    """The store NOX_REMOTE_CACHE points to, or None"""
+    url = os.environ.get('NOX_REMOTE_CACHE')
+    return store_for(url) if url else None
+
+
+def current_system():
+    """The nix system of this machine, like x86_64-linux"""
+    machine = {'amd64': 'x86_64', 'arm64': 'aarch64'}.get(platform.machine().lower(), platform.machine().lower())
+    return '{}-{}'.format(machine, 'darwin' if sys.platform == 'darwin' else sys.platform.rstrip('0123456789'))
+
+
+def encode(value):
+    payload = dumps(value)
+    return hashlib.sha256(payload).digest() + payload
+
+
+def decode(data):
+    """The value in data, or None if it was corrupted"""
+    digest, payload = data[:32], data[32:]
+    if hashlib.sha256(payload).digest() != digest:
+        return None
+    return loads(payload)
+
+
+def remote_cached(namespace):
+    """Decorator sharing the results of f(sha, ...) in the remote cache
+
+    The results are stored under namespace/v<format_version>/system/sha.
+    Results for None
+    (the working directory) are not shared, and any problem with the
+    remote cache is only a warning, the result being computed locally.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def _wrapped(sha, *args, **kwargs):
+            store = remote_store()
+            if store is None or sha is None:
+                return f(sha, *args, **kwargs)
+            key = '{}/v{}/{}/{}'.format(namespace, format_version, current_system(), sha)
+            try:
+                data = store.get(key)
+            except Exception as e:
+                click.echo('Warning: could not read {} from the remote cache: {}'.format(key, e), err=True)
+                data = None
+            if data is not None:
+                value = decode(data)
+                if value is not None:
+                    return value
+                click.echo('Warning: ignoring corrupted {} in the remote cache'.format(key), err=True)
+
+            value = f(sha, *args, **kwargs)
+            try:
+                store.put(key, encode(value))
+            except Exception as e:
+                click.echo('Warning: could not write {} to the remote cache: {}'.format(key, e), err=True)
+            return value
+        return _wrapped
+    return decorator
@@ -1,53 +1,215 @@
+import hashlib
 import os
 import sys
 import tempfile
+import threading
 import subprocess
 import re
 from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import click
-import requests
 
-from .nixpkgs_repo import get_repo, at_given_sha, get_build_commands, packages_for_sha, tests_for_sha
+from . import daemon, trace
+from .nixpkgs_repo import Repo, get_repo, at_given_sha, get_build_commands, packages_for_sha, packages_in_attrs_for_sha, tests_for_sha, Buildable
+from .narrow import narrowed_attributes
+from .build import BuildRecord, BuildResult, known_outcomes, link_results, run_builds, show_summary
+
+
+def build_tasks(builds, jobs=1, extra_args=[]):
+    """run_builds tasks for the (label, buildable, nixpkgs path) builds
+
+    The builds of each nixpkgs and expression are split between at most
+    jobs nix-build invocations, each evaluating nixpkgs once for all its
+    attributes. The outputs are linked by run_builds, not nix-build, which
+    logs in the format run_builds times the builds from.
+    """
+    groups = defaultdict(list)
+    for label, b, path in builds:
+        groups[(path, b.path_args)].append((label, b))
+    tasks = []
+    for (path, _), group in groups.items():
+        for i in range(min(jobs, len(group))):
+            chunk = group[i::jobs]
+            command, = get_build_commands([b for _, b in chunk], extra_args=extra_args + [
+                "-I", "nixpkgs=" + path, "--no-out-link", "--log-format", "internal-json"])
+            tasks.append(('{}s-{}'.format(chunk[0][1].kind, len(tasks) + 1), command, chunk))
+    return tasks
+
+
+def skip_known(buildables, record, rebuild=False, dry_run=False):
+    """Results of the buildables which don't need building, unless rebuild
+
+    A dry run doesn't look, and shows every build.
+    """
+    if rebuild or dry_run:
+        return {}
+    known = known_outcomes(buildables, record)
+    for b, result in sorted(known.items(), key=lambda item: item[0].attr):
+        click.echo('Not building {}: {}'.format(
+            b.attr, 'already built' if result.status == 'cached' else 'it failed before, use --rebuild to retry'))
+    return known
 
 
 @at_given_sha
-def build_sha(path, buildables, extra_args=[], dry_run=False):
-    """Build the given package attributes in the given nixpkgs path"""
+def build_sha(path, buildables, extra_args=[], dry_run=False, jobs=1, keep_going=False, rebuild=False):
+    """Build the given package attributes in the given nixpkgs path
+
+    The attributes are split between jobs nix-build invocations running at
+    the same time, and a summary of the results is shown at the end. Unless
+    rebuild, the attributes already in the store or which failed to build
+    before are not built again, but their outputs are linked all the same.
+    """
     if not buildables:
         click.echo('Nothing changed')
         return
 
+    record = None if dry_run else BuildRecord()
+    known = skip_known(buildables, record, rebuild, dry_run)
     canonical_path = str(Path(path).resolve())
     result_dir = tempfile.mkdtemp(prefix='nox-review-')
+    buildables = sorted(buildables, key=lambda b: b.attr)
+    to_build = [b for b in buildables if b not in known]
     click.echo('Building in {}: {}'.format(click.style(result_dir, bold=True),
-                                           click.style(' '.join(s.attr for s in buildables), bold=True)))
-
-    for command in get_build_commands(buildables, extra_args=extra_args+["-I", "nixpkgs="+canonical_path]):
-        click.echo('Invoking {}'.format(' '.join(command)))
-
-        if not dry_run:
-            try:
-                subprocess.check_call(command, cwd=result_dir)
-            except subprocess.CalledProcessError:
-                click.secho('The invocation of "{}" failed'.format(' '.join(command)), fg='red')
-                sys.exit(1)
-            click.echo('Result in {}'.format(click.style(result_dir, bold=True)))
-            subprocess.check_call(['ls', '-l', result_dir])
-
-
-def build_difference(old_sha, new_sha, extra_args=[], with_tests=False, disable_test_blacklist=False, dry_run=False):
-    click.echo("Listing old packages...")
-    before = packages_for_sha(old_sha)
-    if with_tests:
-        click.echo("Listing old tests...")
-        before |= tests_for_sha(old_sha, disable_test_blacklist)
-    click.echo("Listing new packages...")
-    after = packages_for_sha(new_sha)
-    if with_tests:
-        click.echo("Listing new tests...")
-        after |= tests_for_sha(new_sha, disable_test_blacklist)
-    build_sha(new_sha, after-before, extra_args, dry_run)
+                                           click.style(' '.join(s.attr for s in to_build), bold=True)))
+
+    tasks = build_tasks([(b.attr, b, canonical_path) for b in to_build], jobs, extra_args)
+
+    if dry_run:
+        for _, command, _ in tasks:
+            click.echo('Invoking {}'.format(' '.join(command)))
+        return
+
+    link_results([(b.attr, b) for b, r in known.items() if r.status == 'cached'], result_dir)
+    built = dict(zip((b for _, _, chunk in tasks for _, b in chunk),
+                     run_builds(tasks, result_dir, jobs, keep_going)))
+    record.record((b.hash, r) for b, r in built.items())
+    results = [built.get(b) or known[b] for b in buildables]
+    click.echo('Result in {}'.format(click.style(result_dir, bold=True)))
+    subprocess.check_call(['ls', '-l', result_dir])
+    show_summary(results)
+    if any(r.failed for r in results):
+        sys.exit(1)
+
+
+def packages(sha, shards=1):
+    """packages_for_sha, from the daemon when it's running"""
+    if sha is not None:
+        try:
+            return {Buildable(attr, hash) for attr, hash in daemon.call('packages_for_sha', sha=sha, shards=shards)}
+        except daemon.Unavailable:
+            pass
+    return packages_for_sha(sha, shards=shards)
+
+
+_listings_lock = threading.Lock()
+
+
+def changed_buildables(old_sha, new_sha, with_tests=False, disable_test_blacklist=False, shards=1, narrow=False, listings=None):
+    """Buildables of new_sha which are not in old_sha
+
+    listings keeps what was listed for each sha, so that reviews sharing
+    a commit only list it once, even when they are evaluated concurrently.
+    """
+    attrs = narrowed_attributes(old_sha, new_sha, shards) if narrow else None
+    listings = {} if listings is None else listings
+
+    # every sha has its own working tree, so both sides are listed at once
+    with ThreadPoolExecutor() as executor:
+        def list_buildables(sha):
+            key = (sha, attrs and frozenset(attrs))
+            with _listings_lock:
+                if key not in listings:
+                    if attrs is None:
+                        futures = [executor.submit(packages, sha, shards=shards)]
+                    else:
+                        futures = [executor.submit(packages_in_attrs_for_sha, sha, attrs)]
+                    if with_tests:
+                        futures.append(executor.submit(tests_for_sha, sha, disable_test_blacklist))
+                    listings[key] = futures
+                return listings[key]
+
+        click.echo("Listing old and new packages{}...".format(" and tests" if with_tests else ""))
+        before_futures = list_buildables(old_sha)
+        after_futures = list_buildables(new_sha)
+        before = set().union(*(f.result() for f in before_futures))
+        after = set().union(*(f.result() for f in after_futures))
+    return after - before
+
+
+def build_difference(old_sha, new_sha, extra_args=[], with_tests=False, disable_test_blacklist=False, dry_run=False, shards=1, narrow=False, jobs=1, keep_going=False, rebuild=False):
+    changed = changed_buildables(old_sha, new_sha, with_tests, disable_test_blacklist, shards, narrow)
+    build_sha(new_sha, changed, extra_args, dry_run, jobs, keep_going, rebuild)
+
+
+def build_batch(changes, extra_args=[], dry_run=False, jobs=1, keep_going=False, rebuild=False):
+    """Build what changed in several reviews, each derivation once
+
+    changes maps each review to its new sha and its changed buildables. A
+    buildable changed by several reviews is built once, in the nixpkgs of
+    the first of them, and its result is shown for each review. The
+    buildables of each sha are built together, so that only one working
+    tree is checked out at a time.
+    """
+    reviews = {}
+    for review, (sha, buildables) in changes.items():
+        for b in buildables:
+            reviews.setdefault(b, (sha, []))[1].append(review)
+    if not reviews:
+        click.echo('Nothing changed')
+        return
+    click.echo('{} changed derivations in {} reviews, {} distinct'.format(
+        sum(len(buildables) for _, buildables in changes.values()), len(changes), len(reviews)))
+
+    record = None if dry_run else BuildRecord()
+    known = skip_known(list(reviews), record, rebuild, dry_run)
+    buildables = sorted(reviews, key=lambda b: (b.attr, str(b.hash)))
+    attr_counts = defaultdict(int)
+    for b in buildables:
+        attr_counts[b.attr] += 1
+    labels = {}
+    builds = defaultdict(list)
+    for b in buildables:
+        # attributes built in several versions are told apart by their hash
+        labels[b] = b.attr if attr_counts[b.attr] == 1 else '{}-{}'.format(
+            b.attr, hashlib.sha1(str(b.hash).encode()).hexdigest()[:7])
+        if b not in known:
+            builds[reviews[b][0]].append((labels[b], b))
+
+    result_dir = None
+    if not dry_run:
+        result_dir = tempfile.mkdtemp(prefix='nox-review-')
+        click.echo('Building in {}'.format(click.style(result_dir, bold=True)))
+        link_results([(labels[b], b) for b, r in known.items() if r.status == 'cached'], result_dir)
+    built = {}
+    for sha, sha_builds in builds.items():
+        if not keep_going and any(r.failed for r in built.values()):
+            built.update((b, BuildResult(label, None, 'skipped')) for label, b in sha_builds)
+            continue
+        with get_repo().worktree(sha) as path:
+            path = str(Path(path).resolve())
+            # the logs of each sha are told apart by its prefix
+            tasks = [('{}-{}'.format(sha[:7], name), command, chunk) for name, command, chunk
+                     in build_tasks([(label, b, path) for label, b in sha_builds], jobs, extra_args)]
+            if dry_run:
+                for _, command, _ in tasks:
+                    click.echo('Invoking {}'.format(' '.join(command)))
+                continue
+            built.update(zip((b for _, _, chunk in tasks for _, b in chunk),
+                             run_builds(tasks, result_dir, jobs, keep_going)))
+    if dry_run:
+        return
+    record.record((b.hash, r) for b, r in built.items())
+    results = {**known, **built}
+    for review, (_, changed) in changes.items():
+        click.secho('==> {}'.format(review), bold=True)
+        if changed:
+            show_summary([results[b] for b in buildables if b in changed])
+        else:
+            click.echo('Nothing changed')
+    if any(r.failed for r in results.values()):
+        sys.exit(1)
 
 
 def setup_nixpkgs_config(f):
@@ -65,15 +227,33 @@ def setup_nixpkgs_config(f):
 @click.option('--dry-run', is_flag=True, help="Don't actually build packages, just print the commands that would have been run")
 @click.option('--with-tests', is_flag=True, help="Also rebuild affected NixOS tests")
 @click.option('--all-tests', is_flag=True, help="Do not blacklist tests known to be false positives")
+@click.option('--shards', default=1, type=click.IntRange(min=1), show_default=True,
+              help="Number of concurrent nix-env processes listing the packages")
+@click.option('--narrow', is_flag=True,
+              help="Only list the packages which may be affected by the changed files, "
+                   "guessed from where the packages are defined")
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), show_default=True,
+              help="Number of attributes to build at the same time")
+@click.option('--rebuild', is_flag=True,
+              help="Build even the attributes already built, or which failed to build before")
+@click.option('--profile', type=click.Path(dir_okay=False), envvar='NOX_TRACE',
+              help='Write a Chrome trace of where the time goes to this file')
 @click.pass_context
-def cli(ctx, keep_going, dry_run, with_tests, all_tests):
+def cli(ctx, keep_going, dry_run, with_tests, all_tests, shards, narrow, jobs, rebuild, profile):
     """Review a change by building the touched commits"""
+    if profile:
+        trace.enable(profile)
     ctx.obj = {'extra-args': []}
     if keep_going:
         ctx.obj['extra-args'].append('--keep-going')
     ctx.obj['dry_run'] = dry_run
     ctx.obj['tests'] = with_tests
     ctx.obj['no-blacklist'] = all_tests
+    ctx.obj['shards'] = shards
+    ctx.obj['narrow'] = narrow
+    ctx.obj['jobs'] = jobs
+    ctx.obj['keep_going'] = keep_going
+    ctx.obj['rebuild'] = rebuild
 
 
 @cli.command(short_help='difference between working tree and a commit')
@@ -95,26 +275,17 @@ def wip(ctx, against):
 
     sha = subprocess.check_output(['git', 'rev-parse', '--verify', against]).decode().strip()
 
-    build_difference(sha, None, extra_args=ctx.obj['extra-args'], with_tests=ctx.obj["tests"], disable_test_blacklist=ctx.obj["no-blacklist"], dry_run=ctx.obj['dry_run'])
+    build_difference(sha, None, extra_args=ctx.obj['extra-args'], with_tests=ctx.obj["tests"], disable_test_blacklist=ctx.obj["no-blacklist"], dry_run=ctx.obj['dry_run'], shards=ctx.obj['shards'], narrow=ctx.obj['narrow'], jobs=ctx.obj['jobs'], keep_going=ctx.obj['keep_going'], rebuild=ctx.obj['rebuild'])
 
 
-@cli.command('pr', short_help='changes in a pull request')
-@click.option('--slug', default=None, help='The GitHub "slug" of the repository in the from of owner_name/repo_name.')
-@click.option('--token', help='The GitHub API token to use.')
-@click.option('--merge/--no-merge', default=True, help='Merge the PR against its base.')
-@click.argument('pr', type=click.STRING)
-@click.pass_context
-@setup_nixpkgs_config
-def review_pr(ctx, slug, token, merge, pr):
-    """Build the changes induced by the given pull request"""
-
+def parse_pr(pr, slug):
+    """(slug, number) of a pull request given as a number or an URL"""
     # Allow the 'pr' parameter to be either the numerical ID or an URL to the PR on GitHub.
     # Also if it's an URL, parse the proper --slug argument from that.
     m = re.match('^(?:https?://(?:www\.)?github\.com/([^/]+/[^/]+)/pull/)?([0-9]+)$', pr, re.IGNORECASE)
     if not m:
         click.echo("Error: parameter to 'nox-review pr' must be a valid pull request number or URL.")
         sys.exit(1)
-    pr = m[2]
     if m[1]:
         if slug:
             click.echo("Error: '--slug' option can't be used together with a pull request URL.")
@@ -122,19 +293,26 @@ def review_pr(ctx, slug, token, merge, pr):
         slug = m[1]
     elif not slug:
         slug = 'NixOS/nixpkgs'
+    return slug, m[2]
+
+
+def github_client(token):
+    # only reviewing PRs needs requests, which is slow to import
+    from .github import GitHub
+    return GitHub(token)
 
-    pr_url = 'https://api.github.com/repos/{}/pulls/{}'.format(slug, pr)
-    headers = {}
-    if token:
-        headers['Authorization'] = 'token {}'.format(token)
-    request = requests.get(pr_url, headers=headers)
-    if request.status_code == 403 and request.headers['X-RateLimit-Remaining'] == '0':
+
+def prepare_pr(github, slug, pr, merge, token=None):
+    """Fetch the pull request, and return the old and new shas to compare"""
+    from .github import RateLimitExceeded
+    try:
+        payload = github.pull_request(slug, pr)
+    except RateLimitExceeded:
         click.secho('You have exceeded the GitHub API rate limit. Try again in about an hour.')
         if not token:
             click.secho('Or try running this again, providing an access token:')
             click.secho('$ nox-review pr --token=YOUR_TOKEN_HERE {}'.format(pr))
         sys.exit(1)
-    payload = request.json()
     click.echo('=== Reviewing PR {} : {}'.format(
                click.style(pr, bold=True),
                click.style(payload.get('title', '(n/a)'), bold=True)))
@@ -155,27 +333,55 @@ def review_pr(ctx, slug, token, merge, pr):
 
     if merge:
         click.echo('==> Fetching extra history for merging')
-        depth = 10
-        while not repo.merge_base(head, base):
-            repo.fetch(base_refspec, depth=depth)
-            repo.fetch(head_refspec, depth=depth)
-            depth *= 2
-
-        # It looks like this isn't enough for a merge, so we fetch more
-        repo.fetch(base_refspec, depth=depth)
+        repo.fetch_merge_history(base_refspec, head_refspec, base, head)
 
         click.echo('==> Merging PR into base')
+        return base, repo.merge(base, head)
 
-        repo.checkout(base)
-        repo.git(['merge', head, '--no-ff', '-qm', 'Nox automatic merge'])
-        merged = repo.sha('HEAD')
+    commits = github.get(payload['commits_url'])
+    return commits[-1]['parents'][0]['sha'], payload['head']['sha']
 
-        old = base
-        new = merged
 
-    else:
-        commits = requests.get(payload['commits_url'], headers=headers).json()
-        old = commits[-1]['parents'][0]['sha']
-        new = payload['head']['sha']
+@cli.command('pr', short_help='changes in a pull request')
+@click.option('--slug', default=None, help='The GitHub "slug" of the repository in the from of owner_name/repo_name.')
+@click.option('--token', help='The GitHub API token to use.')
+@click.option('--merge/--no-merge', default=True, help='Merge the PR against its base.')
+@click.argument('pr', type=click.STRING)
+@click.pass_context
+@setup_nixpkgs_config
+def review_pr(ctx, slug, token, merge, pr):
+    """Build the changes induced by the given pull request"""
+    slug, pr = parse_pr(pr, slug)
+    old, new = prepare_pr(github_client(token), slug, pr, merge, token)
+    build_difference(old, new, extra_args=ctx.obj['extra-args'], with_tests=ctx.obj["tests"], disable_test_blacklist=ctx.obj["no-blacklist"], dry_run=ctx.obj['dry_run'], shards=ctx.obj['shards'], narrow=ctx.obj['narrow'], jobs=ctx.obj['jobs'], keep_going=ctx.obj['keep_going'], rebuild=ctx.obj['rebuild'])
+
 
-    build_difference(old, new, extra_args=ctx.obj['extra-args'], with_tests=ctx.obj["tests"], disable_test_blacklist=ctx.obj["no-blacklist"], dry_run=ctx.obj['dry_run'])
+@cli.command('batch', short_help='changes in several pull requests')
+@click.option('--slug', default=None, help='The GitHub "slug" of the repository in the from of owner_name/repo_name.')
+@click.option('--token', help='The GitHub API token to use.')
+@click.option('--merge/--no-merge', default=True, help='Merge the PRs against their base.')
+@click.argument('prs', nargs=-1, required=True)
+@click.pass_context
+@setup_nixpkgs_config
+def review_batch(ctx, slug, token, merge, prs):
+    """Build the changes induced by all the given pull requests
+
+    Each commit is listed once, even when it is the base of several pull
+    requests, and each changed derivation is built once, even when several
+    pull requests change it.
+    """
+    github = github_client(token)
+    listings = {}
+    evaluations = {}
+    # each evaluation checks out two working trees, and releases them once
+    # done: while the next pull requests are fetched, as many are evaluated
+    # as there are working trees kept around
+    with ThreadPoolExecutor(max_workers=max(1, Repo.max_worktrees // 2)) as executor:
+        for pr in prs:
+            pr_slug, pr = parse_pr(pr, slug)
+            old, new = prepare_pr(github, pr_slug, pr, merge, token)
+            evaluations['PR {}#{}'.format(pr_slug, pr)] = (new, executor.submit(
+                changed_buildables, old, new, ctx.obj["tests"], ctx.obj["no-blacklist"], ctx.obj['shards'],
+                ctx.obj['narrow'], listings))
+        changes = {review: (new, changed.result()) for review, (new, changed) in evaluations.items()}
+    build_batch(changes, extra_args=ctx.obj['extra-args'], dry_run=ctx.obj['dry_run'], jobs=ctx.obj['jobs'], keep_going=ctx.obj['keep_going'], rebuild=ctx.obj['rebuild'])
@@ -1,32 +1,70 @@
 import os
-import collections
-import json
+import sys
 import subprocess
-import re
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 
-from .cache import region
+from . import daemon, trace
+from .cachedir import expiration_time, index_dir, file_lock
+from .index import Package, PackageIndex
+from .jsonstream import iter_object_items
 
 
 class NixEvalError(Exception):
     pass
 
 
-def nix_packages_json():
-    click.echo('Refreshing cache')
-    try:
-        output = subprocess.check_output(['nix-env', '-qa', '--json', '--show-trace'],
-                                         universal_newlines=True)
-    except subprocess.CalledProcessError as e:
-        raise NixEvalError from e
-    return json.loads(output)
+def nix_packages(channel, path):
+    """Lazily list the packages of a channel as nix-env outputs them"""
+    click.echo('Refreshing cache for {}'.format(channel))
+    command = ['nix-env', '-f', path, '-qa', '--json', '--show-trace']
+    with trace.command_span(command, channel=channel) as span, \
+            subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True) as process:
+        try:
+            for attr, v in iter_object_items(process.stdout):
+                yield Package(channel + '.' + attr, v['name'],
+                              v.get('meta', {}).get('description', ''))
+        except ValueError:
+            # the output is truncated when nix fails, report that instead
+            if process.wait() == 0:
+                raise
+    span['exit_code'] = process.returncode
+    if process.returncode:
+        raise NixEvalError from subprocess.CalledProcessError(process.returncode, command)
+
 
+def channels(path=None, seen=None):
+    """The (name, path) of the expressions nix-env takes its packages from
 
-Package = collections.namedtuple('Package', 'attribute name description')
+    Like nix-env, this walks ~/.nix-defexpr, flattening the directories which
+    are not expressions themselves and keeping the first of each name.
+    """
+    if path is None:
+        path = os.path.expanduser('~/.nix-defexpr')
+    if seen is None:
+        seen = set()
+    for entry in sorted(os.listdir(path)):
+        if entry.startswith('.') or entry == 'manifest.nix':
+            continue
+        entry_path = os.path.join(path, entry)
+        if os.path.isfile(entry_path) and entry.endswith('.nix'):
+            name = entry[:-len('.nix')]
+        elif os.path.isfile(os.path.join(entry_path, 'default.nix')):
+            name = entry
+        else:
+            if os.path.isdir(entry_path):
+                yield from channels(entry_path, seen)
+            continue
+        if name not in seen:
+            seen.add(name)
+            yield name, entry_path
 
 
 def key_for_path(path):
+    real_path = os.path.realpath(path)
+    if real_path.startswith('/nix/store/'):
+        return real_path
     try:
         manifest = os.path.join(path, 'manifest.nix')
         with open(manifest) as f:
@@ -35,34 +73,157 @@ def key_for_path(path):
         pass
     if os.path.exists(os.path.join(path, '.git')):
         return subprocess.check_output('git rev-parse --verify HEAD'.split(),
-                                       cwd=path)
+                                       cwd=path, universal_newlines=True).strip()
     click.echo('Warning: could not find a version indicator for {}'.format(path))
     return None
 
 
-def all_packages(force_refresh=False):
-    defexpr = os.path.expanduser('~/.nix-defexpr/')
-    paths = os.listdir(defexpr)
-    key = str({p: key_for_path(defexpr + p) for p in paths})
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+
+def channel_signature(path, index_path):
+    """Cheap stand-in for the key of the channel at path and for its index:
+    it changes whenever they may have
+
+    That is where the channel points to, and the files key_for_path and
+    PackageIndex read, by inode and modification time.
+    """
+    signature = [os.path.realpath(path), _stat(index_path), _stat(os.path.join(path, 'manifest.nix'))]
+    git_dir = os.path.join(path, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+    except OSError:
+        return tuple(signature)
+    signature.append(head)
+    if head.startswith('ref: '):
+        signature.append(_stat(os.path.join(git_dir, head[len('ref: '):])))
+        signature.append(_stat(os.path.join(git_dir, 'packed-refs')))
+    return tuple(signature)
+
+
+def is_outdated(index, key):
+    return index is None or index.key != key or index.age > expiration_time
+
+
+def refresh(channel, path, key, force=False, blocking=True):
+    """Index the packages of the channel, unless another process just did
+
+    Only one process evaluates a given channel at a time: the others wait for
+    it and use its result, or give up when not blocking.
+    """
+    index_path = os.path.join(index_dir, channel)
+    with file_lock(index_path + '.lock', blocking) as locked:
+        index = PackageIndex.open(index_path)
+        if locked and (force or is_outdated(index, key)):
+            index = PackageIndex.build(index_path, key, nix_packages(channel, path))
+    return index
+
 
-    if force_refresh:
-        region.delete(key)
+def refresh_in_background(channel):
+    """Start a detached process refreshing the channel, if none is running"""
+    index_path = os.path.join(index_dir, channel)
+    with file_lock(index_path + '.lock', blocking=False) as locked:
+        if not locked:
+            return
+    # the trace of the refresh would overwrite the one of this process
+    env = {k: v for k, v in os.environ.items() if k != 'NOX_TRACE'}
+    with open(index_path + '.log', 'w') as log:
+        subprocess.Popen([sys.executable, '-m', 'nox.search', '--refresh-channel', channel],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                         start_new_session=True, env=env)
 
-    packages_json = region.get_or_create(key, nix_packages_json)
-    return (Package(attr, v['name'], v.get('meta', {}).get('description', ''))
-            for attr, v in packages_json.items())
+
+def all_packages(force_refresh=False, background_refresh=False, opened=None):
+    """Indexes of the packages of each channel
+
+    Each channel is indexed separately, so only the channels which changed
+    are evaluated again, concurrently. With background_refresh, outdated
+    indexes are used as is while a detached process refreshes them.
+
+    opened keeps the indexes open between calls, as {channel: (signature,
+    index)}: an index is used again as long as channel_signature() and its
+    age say it is still up to date.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+
+    indexes = {}
+    outdated = []
+    paths = dict(channels())
+    if opened is not None:
+        for channel in set(opened) - set(paths):
+            del opened[channel]
+    for channel, path in paths.items():
+        if opened is not None and channel in opened and not force_refresh:
+            signature, index = opened[channel]
+            if index.age <= expiration_time and signature == channel_signature(
+                    path, os.path.join(index_dir, channel)):
+                indexes[channel] = index
+                continue
+        key = str(key_for_path(path))
+        index = PackageIndex.open(os.path.join(index_dir, channel))
+        if force_refresh or is_outdated(index, key):
+            if background_refresh and index is not None and not force_refresh:
+                click.echo('Using outdated cache for {}, refreshing it in the background'.format(channel), err=True)
+                refresh_in_background(channel)
+            else:
+                outdated.append((channel, path, key))
+        indexes[channel] = index
+
+    def _refresh(args):
+        channel, path, key = args
+        return channel, refresh(channel, path, key, force_refresh)
+
+    if outdated:
+        with ThreadPoolExecutor(max_workers=min(len(outdated), os.cpu_count() or 1)) as executor:
+            indexes.update(executor.map(_refresh, outdated))
+    if opened is not None:
+        for channel, index in indexes.items():
+            if index is not None and (channel not in opened or opened[channel][1] is not index):
+                opened[channel] = (channel_signature(paths[channel], os.path.join(index_dir, channel)), index)
+    return list(indexes.values())
+
+
+def search(queries, force_refresh=False, background_refresh=False):
+    """Packages matching the queries, found by the daemon when it's running"""
+    if not force_refresh:
+        try:
+            return [Package(*p) for p in daemon.call('search', queries=queries)]
+        except daemon.Unavailable:
+            pass
+    return [p for index in all_packages(force_refresh, background_refresh)
+            for p in index.search(queries)]
+
+
+def refresh_channel(channel):
+    """Refresh the index of a channel, as done by refresh_in_background"""
+    for name, path in channels():
+        if name == channel:
+            refresh(channel, path, str(key_for_path(path)), blocking=False)
 
 
 @click.command()
 @click.argument('queries', nargs=-1)
 @click.option('--force-refresh', is_flag=True)
-def main(queries, force_refresh):
+@click.option('--background-refresh', is_flag=True, envvar='NOX_BACKGROUND_REFRESH',
+              help='Search the outdated cache while it is refreshed in the background')
+@click.option('--refresh-channel', 'refresh_channel_name', hidden=True)
+@click.option('--profile', type=click.Path(dir_okay=False), envvar='NOX_TRACE',
+              help='Write a Chrome trace of where the time goes to this file')
+def main(queries, force_refresh, background_refresh, refresh_channel_name, profile):
     """Search a package in nix"""
-    patterns = [re.compile(query, re.IGNORECASE) for query in queries]
+    if profile:
+        trace.enable(profile)
+    if refresh_channel_name:
+        return refresh_channel(refresh_channel_name)
 
     try:
-        results = [p for p in all_packages(force_refresh)
-                   if any((all((pat.search(s) for pat in patterns)) for s in p))]
+        results = search(queries, force_refresh, background_refresh)
     except NixEvalError:
         raise click.ClickException('An error occured while running nix (displayed above). Maybe the nixpkgs eval is broken.')
     results.sort()
@@ -92,3 +253,7 @@ def main(queries, force_refresh):
         elif action == 'shell':
             attributes = [a[len('nixpkgs.'):] for a in attributes]
             subprocess.check_call(['nix-shell', '-p', '--show-trace'] + attributes)
+
+
+if __name__ == '__main__':
+    main()
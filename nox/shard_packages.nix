@@ -0,0 +1,13 @@
+# small utility to list the packages of nixpkgs in several nix-env processes
+# it only keeps 1/numShards of the top-level attributes of nixpkgs (or of
+# those listed in attrsJSON), which nix-env then recurses into as it does for
+# nixpkgs itself
+{ nixpkgs, shardIndex ? 0, numShards ? 1, attrsJSON ? null }:
+let
+  pkgs = import nixpkgs {};
+  names = if attrsJSON == null then builtins.attrNames pkgs
+    else builtins.filter (name: pkgs ? ${name}) (builtins.fromJSON attrsJSON);
+  count = (builtins.length names - shardIndex + numShards - 1) / numShards;
+  myNames = builtins.genList (i: builtins.elemAt names (shardIndex + i * numShards)) count;
+in
+  builtins.listToAttrs (map (name: { inherit name; value = pkgs.${name}; }) myNames)
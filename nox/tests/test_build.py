@@ -0,0 +1,131 @@
+import json
+import os
+import shlex
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from .. import build
+from ..nixpkgs_repo import Buildable
+from .test_drv import write_drv
+
+
+class TestRunBuilds(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.cwd = tmpdir.name
+
+    def task(self, name, command, *attrs):
+        return name, command, [(attr, Buildable(attr, hash(attr))) for attr in attrs]
+
+    def test_keep_going(self):
+        tasks = [self.task('a', ['true'], 'a'), self.task('b', ['false'], 'b'), self.task('c', ['true'], 'c')]
+        results = build.run_builds(tasks, self.cwd, jobs=2, keep_going=True)
+        self.assertEqual(['a', 'b', 'c'], [r.attr for r in results])
+        self.assertEqual(['ok', 'failed', 'ok'], [r.status for r in results])
+        build.show_summary(results)
+
+    def test_stop_after_failure(self):
+        tasks = [self.task('a', ['false'], 'a'), self.task('b', ['true'], 'b', 'c')]
+        results = build.run_builds(tasks, self.cwd, jobs=1)
+        self.assertEqual(['failed', 'skipped', 'skipped'], [r.status for r in results])
+
+    def test_unattributable_failure(self):
+        a, b = Buildable('a', '/nix/store/aaa-a'), Buildable('b', '/nix/store/bbb-b')
+        tasks = [('packages-1', ['sh', '-c', 'exit 100'], [('a', a), ('b', b)])]
+        with mock.patch.object(build, 'invalid_paths', return_value={a.hash, b.hash}):
+            results = build.run_builds(tasks, self.cwd)
+            # nix-build stopped at the first failure, which isn't known
+            self.assertEqual([None, None], [r.returncode for r in results])
+            results = build.run_builds(tasks, self.cwd, keep_going=True)
+            self.assertEqual([True, True], [r.builder_failed for r in results])
+
+    def test_build_durations(self):
+        a, b = Buildable('a', '/nix/store/aaa-a'), Buildable('b', '/nix/store/bbb-b')
+        events = [{'action': 'start', 'id': 1, 'type': 105, 'level': 3, 'text': "building 'a'",
+                   'fields': ['/nix/store/aaa-a']},
+                  {'action': 'result', 'id': 1, 'type': 101, 'fields': ['compiling a']},
+                  {'action': 'stop', 'id': 1}]
+        lines = ['@nix ' + json.dumps(event) for event in events]
+        script = 'echo {} >&2; echo {} >&2; sleep 0.2; echo {} >&2; echo plain >&2'.format(*map(shlex.quote, lines))
+        tasks = [('packages-1', ['sh', '-c', script], [('a', a), ('b', b)])]
+        with mock.patch.object(build, 'link_outputs'):
+            results = build.run_builds(tasks, self.cwd, jobs=2)
+        self.assertGreaterEqual(results[0].duration, 0.2)
+        # b was already in the store
+        self.assertEqual(0, results[1].duration)
+        with open(results[0].log) as f:
+            self.assertEqual("building 'a'\ncompiling a\nplain\n", f.read())
+
+    def test_partial_failure(self):
+        built = Buildable('built', '/nix/store/aaa-built')
+        broken = Buildable('tests.broken', '/nix/store/bbb-broken', path=('<nixpkgs/nixos/release.nix>',))
+        tasks = [('packages-1', ['false'], [('built', built), ('tests.broken', broken)])]
+        with mock.patch.object(build, 'invalid_paths', return_value={broken.hash}), \
+                mock.patch.object(build, 'link_outputs') as link_outputs:
+            results = build.run_builds(tasks, self.cwd)
+        self.assertEqual(['ok', 'failed'], [r.status for r in results])
+        self.assertEqual(1, results[1].returncode)
+        link_outputs.assert_called_once_with([built.hash], os.path.join(self.cwd, 'result-package-built'))
+        self.assertEqual(os.path.join(self.cwd, 'result-test-tests.broken'),
+                         build.result_link(self.cwd, 'tests.broken', broken))
+
+
+class TestKnownOutcomes(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.store = tmpdir.name
+        self.log_dir = os.path.join(self.store, 'logs')
+        self.record = build.BuildRecord(os.path.join(self.store, 'builds.sqlite'), self.log_dir)
+
+    def test_out_paths(self):
+        multi = Buildable('openssl', '/nix/store/aaa-openssl-bin;/nix/store/bbb-openssl')
+        self.assertEqual(['/nix/store/aaa-openssl-bin', '/nix/store/bbb-openssl'], build.out_paths(multi))
+        drv = write_drv(self.store, 'test', [('out', '/nix/store/ccc-test')])
+        self.assertEqual(['/nix/store/ccc-test'], build.out_paths(Buildable('tests.test', drv)))
+        self.assertEqual([], build.out_paths(Buildable('nox', 42)))
+
+    def test_record(self):
+        log = os.path.join(self.store, 'packages-1.log')
+        with open(log, 'w') as f:
+            f.write('builder for hello failed')
+        self.record.record([('a', build.BuildResult('a', None, 'ok')),
+                            ('b', build.BuildResult('b', None, 'failed', log=log, returncode=100)),
+                            ('c', build.BuildResult('c', None, 'skipped')),
+                            # interrupted, failed to evaluate, or maybe not built
+                            ('d', build.BuildResult('d', None, 'failed', returncode=-2)),
+                            ('e', build.BuildResult('e', None, 'failed', returncode=1)),
+                            ('f', build.BuildResult('f', None, 'failed'))])
+        failures = self.record.failures('abcdef')
+        self.assertEqual(['b'], list(failures))
+        # the log outlives the result directory
+        os.unlink(log)
+        with open(failures['b']) as f:
+            self.assertEqual('builder for hello failed', f.read())
+
+        self.record.record([('b', build.BuildResult('b', None, 'ok'))])
+        self.assertEqual({}, self.record.failures(['b']))
+
+    def test_expired(self):
+        self.record.record([('b', build.BuildResult('b', None, 'failed', returncode=100))])
+        with mock.patch.object(build.time, 'time', return_value=time.time() + build.BuildRecord.failure_lifetime):
+            self.assertEqual({}, self.record.failures(['b']))
+
+    def test_known_outcomes(self):
+        built = Buildable('built', '/nix/store/aaa-built')
+        broken = Buildable('broken', '/nix/store/bbb-broken')
+        changed = Buildable('changed', '/nix/store/ccc-changed')
+        self.record.record([(broken.hash, build.BuildResult('broken', None, 'failed', returncode=100))])
+        invalid = {broken.hash, changed.hash}
+        with mock.patch.object(build, 'invalid_paths', return_value=invalid):
+            known = build.known_outcomes([built, broken, changed], self.record)
+        self.assertEqual({built: 'cached', broken: 'broken'}, {b: r.status for b, r in known.items()})
+        self.assertTrue(known[broken].failed)
+
+    def test_without_nix_store(self):
+        built = Buildable('built', '/nix/store/aaa-built')
+        with mock.patch.object(build, 'invalid_paths', side_effect=FileNotFoundError):
+            self.assertEqual({}, build.known_outcomes([built], self.record))
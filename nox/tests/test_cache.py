@@ -0,0 +1,75 @@
+import os
+import tempfile
+import time
+import unittest
+
+from dogpile.cache.api import CachedValue, NO_VALUE
+
+from .. import cache
+from ..nixpkgs_repo import Buildable
+
+
+class TestFileBackend(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+        self.backend = cache.FileBackend({'directory': self.directory, 'max_size': 1200})
+
+    def test_buildables_roundtrip(self):
+        tests_path = ("<nixpkgs/nixos/release.nix>", "--arg", "supportedSystems", "[builtins.currentSystem]")
+        value = {Buildable("nox", "/nix/store/aaa-nox"),
+                 Buildable("tests.nox", "/nix/store/bbb.drv", path=tests_path)}
+        self.backend.set('key', CachedValue(value, {'ct': 1.0, 'v': 1}))
+        payload, metadata = self.backend.get('key')
+        self.assertEqual({'ct': 1.0, 'v': 1}, metadata)
+        self.assertEqual({(b.attr, b.hash, b.path_args) for b in value},
+                         {(b.attr, b.hash, b.path_args) for b in payload})
+
+    def test_lossless(self):
+        value = {'!set': [1, 2], '!!tuple': (1, 2), '!': {'!Buildable': 'nox'}, 'set': {3}}
+        self.backend.set('key', CachedValue(value, {}))
+        self.assertEqual(value, self.backend.get('key').payload)
+        with self.assertRaises(TypeError):
+            self.backend.set('key', CachedValue({1: 'a'}, {}))
+
+    def test_missing(self):
+        self.assertIs(NO_VALUE, self.backend.get('missing'))
+        self.backend.set('key', CachedValue([1, 2], {}))
+        self.backend.delete('key')
+        self.assertIs(NO_VALUE, self.backend.get('key'))
+
+    def test_eviction(self):
+        for i in range(3):
+            self.backend.set(str(i), CachedValue(os.urandom(300).hex(), {}))
+            # make sure the modification times differ
+            os.utime(self.backend._path(str(i)), (time.time() - 10 + i,) * 2)
+        self.backend.get('0')
+        self.backend.set('3', CachedValue(os.urandom(300).hex(), {}))
+        self.assertIsNot(NO_VALUE, self.backend.get('0'))
+        self.assertIs(NO_VALUE, self.backend.get('1'))
+        self.assertIsNot(NO_VALUE, self.backend.get('3'))
+
+    def test_locks_evicted(self):
+        held = self.backend.get_mutex('held')
+        self.assertTrue(held.acquire())
+        for i in range(4):
+            mutex = self.backend.get_mutex(str(i))
+            mutex.acquire()
+            self.backend.set(str(i), CachedValue(os.urandom(300).hex(), {}))
+            mutex.release()
+        values = set(os.listdir(self.directory)) - {'locks'}
+        self.assertEqual(3, len(values))
+        # the lock is kept while it's held, though its value is not cached
+        held_lock = os.path.basename(self.backend._path('held'))
+        self.assertEqual(values | {held_lock}, set(os.listdir(self.backend.lock_dir)))
+        held.release()
+
+    def test_mutex(self):
+        first = self.backend.get_mutex('key')
+        second = self.backend.get_mutex('key')
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire(wait=False))
+        first.release()
+        self.assertTrue(second.acquire(wait=False))
+        second.release()
@@ -0,0 +1,131 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from dogpile.cache import make_region
+
+from .. import cache, daemon, nixpkgs_repo, search, update
+from ..index import Package, PackageIndex
+from .test_drv import write_drv
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.store = tmpdir.name
+        path = os.path.join(tmpdir.name, 'nox.sock')
+        patcher = mock.patch.object(daemon, 'socket_path', return_value=path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.server = daemon.Server(path)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_changes(self):
+        zlib = write_drv(self.store, 'zlib-1.2.11', [('out', '/nix/store/out-zlib')])
+        old = write_drv(self.store, 'hello-2.10', [('out', '/nix/store/out-hello-2.10')], input_drvs=[zlib])
+        new = write_drv(self.store, 'hello-2.12', [('out', '/nix/store/out-hello-2.12')], input_drvs=[zlib])
+        changes = list(daemon.stream('changes', current=old, new=new))
+        self.assertEqual([[None, new, 'version', old, None, None]], changes)
+
+        with mock.patch.object(cache, 'region', make_region().configure('dogpile.cache.memory')), \
+                mock.patch.object(daemon, 'stream', wraps=daemon.stream) as stream:
+            (parent, drv, change), = update.remembered_changes(update.NixPath(old), update.NixPath(new),
+                                                               {'max_level': 0})
+            stream.assert_called_once_with('changes', current=old, new=new, max_level=0)
+        self.assertEqual((None, new, update.ChangeType.version, old),
+                         (parent, drv.path, change.ctype, change.old.path))
+
+    def test_stream(self):
+        zlib = write_drv(self.store, 'zlib-1.2.11', [('out', '/nix/store/out-zlib-1.2.11')])
+        old = write_drv(self.store, 'hello-2.10', [('out', '/nix/store/out-hello-2.10')], input_drvs=[zlib])
+        new_zlib = write_drv(self.store, 'zlib-1.2.12', [('out', '/nix/store/out-zlib-1.2.12')])
+        new = write_drv(self.store, 'hello-2.12', [('out', '/nix/store/out-hello-2.12')], input_drvs=[new_zlib])
+        with mock.patch.object(daemon.Handler, 'chunk_size', 1), \
+                mock.patch.object(daemon.Handler, 'respond', autospec=True,
+                                  side_effect=daemon.Handler.respond) as respond:
+            changes = list(daemon.stream('changes', current=old, new=new, max_level=1))
+        self.assertEqual([new, new_zlib], [drv for _, drv, *_ in changes])
+        # one response for each change, and the end of the stream
+        self.assertEqual(3, respond.call_count)
+        self.assertEqual({'result': None}, respond.call_args[0][1])
+
+    def test_packages_for_sha(self):
+        with mock.patch.object(nixpkgs_repo, 'packages_for_sha') as packages_for_sha:
+            packages_for_sha.return_value = {nixpkgs_repo.Buildable('hello', '/nix/store/out-hello')}
+            self.assertEqual([['hello', '/nix/store/out-hello']], daemon.call('packages_for_sha', sha='abc'))
+            self.assertEqual([['hello', '/nix/store/out-hello']], daemon.call('packages_for_sha', sha='abc'))
+            packages_for_sha.assert_called_once_with('abc', shards=1)
+
+    def test_packages_bounded(self):
+        with mock.patch.object(nixpkgs_repo, 'packages_for_sha', return_value=set()) as packages_for_sha:
+            for sha in range(10):
+                daemon.call('packages_for_sha', sha=str(sha))
+            daemon.call('packages_for_sha', sha='9')
+            daemon.call('packages_for_sha', sha='0')
+        self.assertEqual(11, packages_for_sha.call_count)
+
+    def test_search(self):
+        channel = os.path.join(self.store, 'nixpkgs')
+        index_dir = os.path.join(self.store, 'index')
+        os.makedirs(channel)
+        os.makedirs(index_dir)
+        PackageIndex.build(os.path.join(index_dir, 'nixpkgs'), 'key',
+                           [Package('nixpkgs.hello', 'hello-2.10', 'A program that produces a familiar greeting')])
+        with mock.patch.object(search, 'channels', return_value=[('nixpkgs', channel)]), \
+                mock.patch.object(search, 'index_dir', index_dir), \
+                mock.patch.object(search, 'key_for_path', return_value='key') as key_for_path:
+            self.assertEqual([['nixpkgs.hello', 'hello-2.10', 'A program that produces a familiar greeting']],
+                             daemon.call('search', queries=['hello']))
+            self.assertEqual(1, len(daemon.call('search', queries=['greeting'])))
+            # the index is kept open
+            self.assertEqual(1, key_for_path.call_count)
+
+            PackageIndex.build(os.path.join(index_dir, 'nixpkgs'), 'key',
+                               [Package('nixpkgs.hello', 'hello-2.12', 'A program that produces a familiar greeting')])
+            self.assertEqual('hello-2.12', daemon.call('search', queries=['hello'])[0][1])
+
+    def test_errors(self):
+        with self.assertRaisesRegex(daemon.Failed, "no method 'unknown'"):
+            daemon.call('unknown')
+        # only the methods meant to be called remotely can be
+        for name in ('__init__', '__class__', 'max_drvs', 'packages', 'indexes'):
+            with self.assertRaisesRegex(daemon.Failed, 'AttributeError: no method {!r}'.format(name)):
+                daemon.call(name)
+        # failures of the daemon are not worked around
+        with mock.patch.object(nixpkgs_repo, 'packages_for_sha', side_effect=ValueError('truncated')), \
+                self.assertRaisesRegex(daemon.Failed, 'ValueError: truncated'):
+            daemon.call('packages_for_sha', sha='abc')
+        with mock.patch.object(daemon, 'answer_timeout', 0.1), \
+                mock.patch.object(nixpkgs_repo, 'packages_for_sha', side_effect=lambda *args, **kwargs: time.sleep(1)), \
+                self.assertRaises(daemon.Failed):
+            daemon.call('packages_for_sha', sha='slow')
+        self.server.shutdown()
+        self.server.server_close()
+        os.unlink(daemon.socket_path())
+        with self.assertRaises(daemon.Unavailable):
+            daemon.call('search', queries=['hello'])
+
+    def test_computed_once(self):
+        started = threading.Event()
+
+        def packages_for_sha(sha, shards):
+            started.set()
+            time.sleep(0.2)
+            return {nixpkgs_repo.Buildable('hello', '/nix/store/out-hello')}
+        with mock.patch.object(nixpkgs_repo, 'packages_for_sha', side_effect=packages_for_sha) as computed:
+            first = threading.Thread(target=daemon.call, args=('packages_for_sha',), kwargs={'sha': 'abc'})
+            first.start()
+            started.wait()
+            self.assertEqual([['hello', '/nix/store/out-hello']], daemon.call('packages_for_sha', sha='abc'))
+            first.join()
+        self.assertEqual(1, computed.call_count)
+        self.assertEqual({}, self.server.methods.packages.computing)
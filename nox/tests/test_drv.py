@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+
+from .. import drv, update
+
+
+def write_drv(store, name, outputs, input_drvs=(), input_srcs=(), env=()):
+    path = os.path.join(store, 'a' * 32 + '-' + name + '.drv')
+    with open(path, 'w') as f:
+        f.write('Derive([{}],[{}],[{}],"x86_64-linux","/bin/sh",["-e","echo \\"hi\\""],[{}])'.format(
+            ','.join('("{}","{}","","")'.format(o, p) for o, p in outputs),
+            ','.join('("{}",["out"])'.format(d) for d in input_drvs),
+            ','.join('"{}"'.format(s) for s in input_srcs),
+            ','.join('("{}","{}")'.format(k, v) for k, v in env)))
+    return path
+
+
+class TestDrv(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.store = tmpdir.name
+        self.dep = write_drv(self.store, 'zlib-1.2.11', [('out', '/nix/store/b-zlib-1.2.11')])
+        self.drv = write_drv(self.store, 'nox-0.0.7',
+                             [('out', '/nix/store/c-nox-0.0.7'), ('man', '/nix/store/d-nox-0.0.7-man')],
+                             input_drvs=[self.dep], input_srcs=['/nix/store/e-builder.sh'],
+                             env=[('name', 'nox-0.0.7'), ('script', 'a\\nb \\\\ c')])
+
+    def test_parse(self):
+        d = drv.read_drv(self.drv)
+        self.assertEqual({'out': '/nix/store/c-nox-0.0.7', 'man': '/nix/store/d-nox-0.0.7-man'}, d.outputs)
+        self.assertEqual({self.dep: ['out']}, d.input_drvs)
+        self.assertEqual(['/nix/store/e-builder.sh'], d.input_srcs)
+        self.assertEqual(['-e', 'echo "hi"'], d.args)
+        self.assertEqual({'name': 'nox-0.0.7', 'script': 'a\nb \\ c'}, d.env)
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            drv.parse_drv('Derive([("out","/nix/store/c-nox","","")],[')
+
+    def test_malformed(self):
+        for text in ('Derive([])])', ')', 'Derive(]', 'Derive("a")x'):
+            with self.assertRaisesRegex(ValueError, 'Unexpected'):
+                drv.parse_drv(text)
+
+    def test_nix_path(self):
+        path = update.NixPath(self.drv)
+        self.assertEqual(('nox', '0.0.7'), (path.name, path.version))
+        self.assertEqual({'/nix/store/c-nox-0.0.7', '/nix/store/d-nox-0.0.7-man'}, path.outputs())
+        self.assertEqual({self.dep, '/nix/store/e-builder.sh'}, {p.path for p in path.refs()})
@@ -0,0 +1,113 @@
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+from dogpile.cache import make_region
+
+from ..github import GitHub, RateLimitExceeded
+from ..nixpkgs_repo import Repo
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    payload = {'title': 'nox: 0.0.7 -> 0.0.8', 'base': {'ref': 'master'}}
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.path == '/rate_limited':
+            self.send_response(403)
+            self.send_header('X-RateLimit-Remaining', '0')
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+        else:
+            body = json.dumps(self.payload).encode()
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestGitHub(unittest.TestCase):
+    def setUp(self):
+        server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        StubHandler.requests = []
+        cache = make_region().configure('dogpile.cache.memory')
+        self.github = GitHub(api_url='http://127.0.0.1:{}'.format(server.server_port), cache=cache)
+
+    def test_etag_cache(self):
+        self.assertEqual(StubHandler.payload, self.github.pull_request('NixOS/nixpkgs', 1))
+        self.assertEqual(StubHandler.payload, self.github.pull_request('NixOS/nixpkgs', 1))
+        self.assertEqual([('/repos/NixOS/nixpkgs/pulls/1', None),
+                          ('/repos/NixOS/nixpkgs/pulls/1', '"v1"')], StubHandler.requests)
+
+    def test_rate_limit(self):
+        with self.assertRaises(RateLimitExceeded):
+            self.github.get('/rate_limited')
+
+
+def git(cwd, *args):
+    return subprocess.check_output(['git', '-c', 'commit.gpgSign=false'] + list(args), cwd=cwd,
+                                   universal_newlines=True).strip()
+
+
+class TestFetchMergeHistory(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        # a stand-in for GitHub: a PR forked 30 commits before master
+        upstream = os.path.join(tmpdir.name, 'upstream')
+        git(tmpdir.name, 'init', '--quiet', upstream)
+        git(upstream, 'config', 'user.email', 'nox@example.com')
+        git(upstream, 'config', 'user.name', 'nox')
+        for i in range(40):
+            git(upstream, 'commit', '--quiet', '--allow-empty', '-m', str(i))
+        git(upstream, 'update-ref', 'refs/heads/base', 'HEAD')
+        git(upstream, 'checkout', '--quiet', 'HEAD~30')
+        git(upstream, 'commit', '--quiet', '--allow-empty', '-m', 'pr')
+        git(upstream, 'update-ref', 'refs/pull/1/head', 'HEAD')
+        self.base = git(upstream, 'rev-parse', 'refs/heads/base')
+        self.head = git(upstream, 'rev-parse', 'refs/pull/1/head')
+
+        self.cache = make_region().configure('dogpile.cache.memory')
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmpdir.name)
+        self.local = os.path.join(tmpdir.name, 'local')
+        self.remote = 'file://' + upstream
+
+    def fetch_history(self):
+        repo = Repo(self.local, remote=self.remote, cache=self.cache)
+        repo.fetch('heads/base')
+        repo.fetch('pull/1/head')
+        with mock.patch.object(repo, 'fetch', wraps=repo.fetch) as fetch:
+            repo.fetch_merge_history('heads/base', 'pull/1/head', self.base, self.head)
+        self.assertTrue(repo.merge_base(self.base, self.head))
+        return [call[1]['depth'] for call in fetch.call_args_list]
+
+    def test_merge(self):
+        self.fetch_history()
+        repo = Repo(self.local, remote=self.remote, cache=self.cache)
+        for _ in range(2):
+            merged = repo.merge(self.base, self.head)
+            self.assertEqual([self.base, self.head], git(self.local, 'rev-parse', merged + '^@').split())
+        # not merged in the repo itself, whose HEAD is still unborn
+        self.assertNotEqual(0, subprocess.call(['git', 'rev-parse', '--verify', '--quiet', 'HEAD'], cwd=self.local,
+                                               stdout=subprocess.DEVNULL))
+
+    def test_remembered_depth(self):
+        self.assertEqual([10, 10, 20, 20, 40, 40, 80], self.fetch_history())
+        subprocess.check_call(['rm', '-rf', self.local])
+        self.assertEqual([40, 40, 80], self.fetch_history())
@@ -0,0 +1,58 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from .. import index
+from ..index import Package, PackageIndex, query_trigrams
+
+
+class TestPackageIndex(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        self.packages = [
+            Package('nixpkgs.nox', 'nox-0.0.7', 'Tools to make nix nicer to use'),
+            Package('nixpkgs.hello', 'hello-2.10', 'A program that produces a familiar, friendly greeting'),
+            Package('nixpkgs.python3', 'python3-3.6.4', 'A high-level dynamically-typed programming language'),
+        ]
+        self.index = PackageIndex.build(os.path.join(tmpdir.name, 'index'), 'key', iter(self.packages))
+
+    def test_roundtrip(self):
+        self.assertEqual(self.packages, list(self.index))
+        self.assertEqual('key', self.index.key)
+
+    def test_literal_search(self):
+        self.assertEqual([self.packages[0]], self.index.search(['NICER']))
+        self.assertEqual([self.packages[1], self.packages[2]], self.index.search(['program']))
+        self.assertEqual([], self.index.search(['nox', 'hello']))
+
+    def test_regex_search(self):
+        self.assertIsNone(query_trigrams('py.*n'))
+        self.assertEqual([self.packages[2]], self.index.search(['py.*n']))
+        self.assertEqual([self.packages[1]], self.index.search(['program', 'ing$']))
+
+    def test_missing_index(self):
+        self.assertIsNone(PackageIndex.open(os.path.join(os.path.dirname(self.index.path), 'missing')))
+
+    def test_uri_characters(self):
+        directory = os.path.join(self.tmpdir, 'what?100%#')
+        os.makedirs(directory)
+        PackageIndex.build(os.path.join(directory, 'index'), 'key', iter(self.packages))
+        self.assertEqual(self.packages, list(PackageIndex.open(os.path.join(directory, 'index'))))
+
+    def test_unusable_closed(self):
+        with sqlite3.connect(self.index.path) as db:
+            db.execute("DELETE FROM meta WHERE name = 'key'")
+        connections = []
+        real_connect = sqlite3.connect
+
+        def connect(*args, **kwargs):
+            connections.append(real_connect(*args, **kwargs))
+            return connections[-1]
+        with mock.patch.object(index.sqlite3, 'connect', side_effect=connect):
+            self.assertIsNone(PackageIndex.open(self.index.path))
+        with self.assertRaises(sqlite3.ProgrammingError):
+            connections[0].execute('SELECT 1')
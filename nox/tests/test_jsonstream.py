@@ -0,0 +1,25 @@
+import io
+import json
+import unittest
+
+from ..jsonstream import iter_object_items
+
+
+class TestIterObjectItems(unittest.TestCase):
+    def check(self, data, chunk_size=3):
+        expected = list(json.loads(data).items())
+        self.assertEqual(expected, list(iter_object_items(io.StringIO(data), chunk_size)))
+
+    def test_items(self):
+        self.check('{"nixpkgs.nox": {"name": "nox-0.0.7", "meta": {"description": "a \\"}\\" b"}},'
+                   ' "nixpkgs.hello": {"name": "hello-2.10"}}')
+
+    def test_numbers_across_chunks(self):
+        self.check('{"a": 12345, "b": [1.5e10, -2], "c": 678}', chunk_size=2)
+
+    def test_empty(self):
+        self.check(' { } ')
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            list(iter_object_items(io.StringIO('{"a": {"name": "x"}, "b": {"na'), 4))
@@ -0,0 +1,46 @@
+import subprocess
+import unittest
+from unittest import mock
+
+from .. import narrow, nixpkgs_repo
+
+
+class TestAffectedAttributes(unittest.TestCase):
+    index = {
+        'drvs': {'hello': '/nix/store/a-hello.drv', 'git': '/nix/store/b-git.drv',
+                 'gitAndTools.hub': '/nix/store/c-hub.drv'},
+        'files': {'pkgs/applications/misc/hello/default.nix': ['hello'],
+                  'pkgs/applications/version-management/git/default.nix': ['git'],
+                  'pkgs/applications/version-management/hub/default.nix': ['gitAndTools.hub']},
+    }
+
+    @mock.patch('subprocess.check_output')
+    def test_dependents(self, check_output):
+        check_output.return_value = '/nix/store/b-git.drv\n/nix/store/c-hub.drv\n/nix/store/d-other.drv\n'
+        affected = narrow.affected_attributes(self.index, [
+            'pkgs/applications/version-management/git/fix.patch', 'nixos/modules/foo.nix'])
+        self.assertEqual({'git', 'gitAndTools.hub'}, affected)
+        self.assertEqual(['/nix/store/b-git.drv'], check_output.call_args[0][0][3:])
+
+    @mock.patch('subprocess.check_output', return_value='')
+    def test_chunked(self, check_output):
+        narrow.affected_attributes(self.index, ['pkgs/applications/misc/hello/default.nix',
+                                                'pkgs/applications/version-management/git/default.nix'],
+                                   chunk_size=1)
+        self.assertEqual([['/nix/store/a-hello.drv'], ['/nix/store/b-git.drv']],
+                         [c[0][0][3:] for c in check_output.call_args_list])
+
+    def test_core_file(self):
+        self.assertIsNone(narrow.affected_attributes(self.index, ['pkgs/top-level/all-packages.nix']))
+
+    def test_unknown_file(self):
+        self.assertIsNone(narrow.affected_attributes(self.index, ['pkgs/development/libraries/new/default.nix']))
+
+
+class TestAttributeIndex(unittest.TestCase):
+    def test_failed_evaluation(self):
+        # nix-env stops in the middle of its output
+        command = ['sh', '-c', 'echo \'{"hello": {"drvPath": "/nix/store/a-hello.drv"},\'; exit 1']
+        with mock.patch.object(nixpkgs_repo, 'nix_env_command', return_value=command), \
+                self.assertRaises(subprocess.CalledProcessError):
+            nixpkgs_repo.attribute_index_for_sha(None)
@@ -0,0 +1,93 @@
+import os
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+from .. import remote_cache
+from ..nixpkgs_repo import Buildable
+
+
+class StoreHandler(BaseHTTPRequestHandler):
+    entries = {}
+
+    def do_GET(self):
+        data = self.entries.get(self.path)
+        self.send_response(404 if data is None else 200)
+        self.send_header('Content-Length', str(len(data or b'')))
+        self.end_headers()
+        self.wfile.write(data or b'')
+
+    def do_PUT(self):
+        self.entries[self.path] = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRemoteCache(unittest.TestCase):
+    packages = {Buildable('hello', '/nix/store/aaa-hello-2.10'), Buildable('nox', '/nix/store/bbb-nox-0.0.7')}
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+        self.evaluations = []
+
+        @remote_cache.remote_cached('packages')
+        def packages_for_sha(sha):
+            self.evaluations.append(sha)
+            return self.packages
+        self.packages_for_sha = packages_for_sha
+
+    def check_shared(self, url):
+        with mock.patch.dict(os.environ, {'NOX_REMOTE_CACHE': url}):
+            for _ in range(2):
+                packages = self.packages_for_sha('0123abcd')
+                self.assertEqual({(b.attr, b.hash) for b in self.packages}, {(b.attr, b.hash) for b in packages})
+            self.assertEqual(['0123abcd'], self.evaluations)
+
+    def test_directory(self):
+        umask = os.umask(0o022)
+        try:
+            self.check_shared(self.directory)
+        finally:
+            os.umask(umask)
+        key = os.path.join(self.directory, 'packages', 'v1', remote_cache.current_system(), '0123abcd')
+        self.assertTrue(os.path.exists(key))
+        # other reviewers can read it
+        self.assertEqual(0o644, os.stat(key).st_mode & 0o777)
+
+        # a corrupted entry is evaluated again
+        with open(key, 'r+b') as f:
+            f.seek(40)
+            f.write(b'corrupted')
+        with mock.patch.dict(os.environ, {'NOX_REMOTE_CACHE': 'file://' + self.directory}):
+            self.packages_for_sha('0123abcd')
+        self.assertEqual(['0123abcd'] * 2, self.evaluations)
+
+    def test_http(self):
+        server = HTTPServer(('127.0.0.1', 0), StoreHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.check_shared('http://127.0.0.1:{}/cache/'.format(server.server_port))
+        self.assertEqual(['/cache/packages/v1/{}/0123abcd'.format(remote_cache.current_system())],
+                         list(StoreHandler.entries))
+        # the connections are pooled in one session
+        url = 'http://127.0.0.1:{}/cache/'.format(server.server_port)
+        with mock.patch.dict(os.environ, {'NOX_REMOTE_CACHE': url}):
+            self.assertIs(remote_cache.remote_store(), remote_cache.remote_store())
+
+    def test_unreachable(self):
+        with mock.patch.dict(os.environ, {'NOX_REMOTE_CACHE': 'http://127.0.0.1:1'}):
+            self.assertEqual(self.packages, self.packages_for_sha('0123abcd'))
+
+    def test_working_directory(self):
+        with mock.patch.dict(os.environ, {'NOX_REMOTE_CACHE': self.directory}):
+            self.packages_for_sha(None)
+        self.assertEqual([], os.listdir(self.directory))
@@ -1,6 +1,16 @@
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-from .. import review, nixpkgs_repo
+from .. import build, review, nixpkgs_repo
 
 
 class TestReview(unittest.TestCase):
@@ -9,7 +19,194 @@ class TestReview(unittest.TestCase):
         result = review.get_build_commands([nox])
         self.assertEqual([["nix-build", "-A", "nox", "<nixpkgs>"]], result)
 
+    def test_build_tasks(self):
+        packages = [nixpkgs_repo.Buildable(attr, attr) for attr in 'abcde']
+        test = nixpkgs_repo.Buildable('tests.a', 'tests.a', path=('<nixpkgs/nixos/release.nix>',))
+        tasks = review.build_tasks([(b.attr, b, '/nixpkgs') for b in packages + [test]], jobs=2)
+        self.assertEqual(['packages-1', 'packages-2', 'tests-3'], [name for name, _, _ in tasks])
+        self.assertEqual(['nix-build', '-I', 'nixpkgs=/nixpkgs', '--no-out-link',
+                          '--log-format', 'internal-json', '-A', 'a', '-A', 'c', '-A', 'e',
+                          '<nixpkgs>'], tasks[0][1])
+        self.assertEqual([[test]], [[b for _, b in builds] for _, _, builds in tasks[2:]])
+
+    def test_cache_key(self):
+        def tests(sha, disable_blacklist=False, shards=1):
+            pass
+        key = nixpkgs_repo.key_ignoring('shards')(None, nixpkgs_repo.at_given_sha(tests))
+        self.assertEqual(key('abc'), key('abc', shards=8))
+        self.assertEqual(key('abc', True), key('abc', disable_blacklist=True))
+        self.assertNotEqual(key('abc'), key('abc', disable_blacklist=True))
+
     def test_build_in_path(self):
         nox = nixpkgs_repo.Buildable("nox", hash("nox"))
         # Just do a dry run to make sure there aren't any exceptions
         self.assertIs(None, review.build_sha(None, [nox], extra_args=[], dry_run=True))
+
+    def test_cached_linked(self):
+        built = nixpkgs_repo.Buildable('hello', '/nix/store/aaa-hello')
+        with mock.patch.object(review, 'BuildRecord', return_value=build.BuildRecord(':memory:')), \
+                mock.patch.object(build, 'invalid_paths', return_value=set()), \
+                mock.patch.object(build, 'link_outputs') as link_outputs, \
+                mock.patch.object(review, 'run_builds', return_value=[]) as run_builds, \
+                mock.patch.object(review.subprocess, 'check_call'):
+            review.build_sha(None, [built])
+        run_builds.assert_called_once_with([], mock.ANY, 1, False)
+        result_dir = run_builds.call_args[0][1]
+        link_outputs.assert_called_once_with([built.hash], os.path.join(result_dir, 'result-package-hello'))
+
+
+class TestTests(unittest.TestCase):
+    names = ['tests.nat.firewall', 'tests.nat.standalone', 'tests.nginx', 'tests.broken']
+
+    def evaluate(self, command):
+        if nixpkgs_repo.list_tests in command:
+            return json.dumps(self.names)
+        attrs = json.loads(command[command.index('attrsJSON') + 1])
+        return json.dumps([{'attr': attr, 'drv': None if 'broken' in attr else '/nix/store/{}.drv'.format(attr)}
+                           for attr in attrs])
+
+    @mock.patch.object(nixpkgs_repo, 'max_workers', return_value=3)
+    def test_tests_for_sha(self, max_workers):
+        with mock.patch.object(nixpkgs_repo, 'evaluate', side_effect=self.evaluate) as evaluate:
+            tests = nixpkgs_repo.tests_for_sha(None)
+            self.assertEqual({('tests.nat.firewall', '/nix/store/tests.nat.firewall.drv'),
+                              ('tests.nat.standalone', '/nix/store/tests.nat.standalone.drv'),
+                              ('tests.nginx', '/nix/store/tests.nginx.drv')},
+                             {(t.attr, t.hash) for t in tests})
+            # the names are listed once, and instantiated by 3 jobs
+            self.assertEqual(4, evaluate.call_count)
+            self.assertIn('false', evaluate.call_args_list[0][0][0])
+
+
+class TestBatch(unittest.TestCase):
+    def test_listed_once(self):
+        listings = {
+            'base': {nixpkgs_repo.Buildable('hello', 'hello-1'), nixpkgs_repo.Buildable('nox', 'nox-1')},
+            'pr1': {nixpkgs_repo.Buildable('hello', 'hello-2'), nixpkgs_repo.Buildable('nox', 'nox-1')},
+            'pr2': {nixpkgs_repo.Buildable('hello', 'hello-2'), nixpkgs_repo.Buildable('nox', 'nox-2')},
+        }
+        with mock.patch.object(review, 'packages', side_effect=lambda sha, shards: listings[sha]) as packages:
+            shared = {}
+            pr1 = review.changed_buildables('base', 'pr1', listings=shared)
+            pr2 = review.changed_buildables('base', 'pr2', listings=shared)
+        self.assertEqual({'hello-2'}, {b.hash for b in pr1})
+        self.assertEqual({'hello-2', 'nox-2'}, {b.hash for b in pr2})
+        self.assertEqual(['base', 'pr1', 'pr2'], [c[0][0] for c in packages.call_args_list])
+
+    def test_listed_once_concurrently(self):
+        def packages(sha, shards):
+            time.sleep(0.1)
+            return {nixpkgs_repo.Buildable('hello', 'hello-' + sha)}
+        shared = {}
+        with mock.patch.object(review, 'packages', side_effect=packages) as listed, \
+                ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(review.changed_buildables, 'base', pr, listings=shared) for pr in ('pr1', 'pr2')]
+            self.assertEqual([{'hello-pr1'}, {'hello-pr2'}], [{b.hash for b in f.result()} for f in futures])
+        self.assertEqual(['base', 'pr1', 'pr2'], sorted(c[0][0] for c in listed.call_args_list))
+
+    def test_built_once(self):
+        hello = nixpkgs_repo.Buildable('hello', 'hello-2')
+        changes = {'PR 1': ('pr1', {hello, nixpkgs_repo.Buildable('nox', 'nox-2')}),
+                   'PR 2': ('pr2', {nixpkgs_repo.Buildable('hello', 'hello-2'), nixpkgs_repo.Buildable('nox', 'nox-3')})}
+        in_use = []
+
+        @contextlib.contextmanager
+        def worktree(sha):
+            in_use.append(sha)
+            # one working tree at a time
+            self.assertEqual(1, len(in_use))
+            yield '/worktrees/' + sha
+            in_use.remove(sha)
+        repo = mock.Mock()
+        repo.worktree.side_effect = worktree
+
+        def run_builds(tasks, cwd, jobs, keep_going):
+            return [build.BuildResult(label, command, 'failed', returncode=100) if label.startswith('nox') else
+                    build.BuildResult(label, command, 'ok')
+                    for _, command, builds in tasks for label, _ in builds]
+
+        def tasks_of(calls):
+            return [task for c in calls for task in c[0][0]]
+
+        def labels(tasks):
+            return [[label for label, _ in builds] for _, _, builds in tasks]
+
+        record = build.BuildRecord(':memory:')
+        with mock.patch.object(review, 'get_repo', return_value=repo), \
+                mock.patch.object(review, 'BuildRecord', return_value=record), \
+                mock.patch.object(review, 'run_builds', side_effect=run_builds) as builds, \
+                mock.patch.object(review, 'show_summary') as show_summary:
+            with self.assertRaises(SystemExit):
+                review.build_batch(changes, keep_going=True)
+            tasks = tasks_of(builds.call_args_list)
+            summaries = [[r.attr for r in c[0][0]] for c in show_summary.call_args_list]
+            # the failures are remembered, and not built again unless asked
+            builds.reset_mock()
+            with self.assertRaises(SystemExit):
+                review.build_batch(changes)
+            self.assertEqual([['hello']], labels(tasks_of(builds.call_args_list)))
+            builds.reset_mock()
+            with self.assertRaises(SystemExit):
+                review.build_batch(changes, rebuild=True, keep_going=True)
+            self.assertEqual(labels(tasks), labels(tasks_of(builds.call_args_list)))
+
+        # one nix-build per commit, with each attribute once
+        (hello_label, nox2), (nox3,) = labels(tasks)
+        self.assertEqual('hello', hello_label)
+        self.assertIn('nixpkgs=/worktrees/pr1', tasks[0][1])
+        self.assertIn('nixpkgs=/worktrees/pr2', tasks[1][1])
+        self.assertTrue(nox2.startswith('nox-') and nox3.startswith('nox-') and nox2 != nox3)
+        self.assertEqual([['hello', nox2], ['hello', nox3]], summaries)
+
+    def test_stop_after_failure(self):
+        changes = {'PR 1': ('pr1', {nixpkgs_repo.Buildable('hello', 'hello-2')}),
+                   'PR 2': ('pr2', {nixpkgs_repo.Buildable('nox', 'nox-2')})}
+        repo = mock.Mock()
+        repo.worktree.side_effect = lambda sha: contextlib.nullcontext('/worktrees/' + sha)
+        with mock.patch.object(review, 'get_repo', return_value=repo), \
+                mock.patch.object(review, 'BuildRecord', return_value=build.BuildRecord(':memory:')), \
+                mock.patch.object(review, 'run_builds', return_value=[build.BuildResult('hello', None, 'failed')]), \
+                mock.patch.object(review, 'show_summary') as show_summary:
+            with self.assertRaises(SystemExit):
+                review.build_batch(changes)
+        # the second commit isn't even checked out
+        repo.worktree.assert_called_once_with('pr1')
+        self.assertEqual(['skipped'], [r.status for r in show_summary.call_args_list[1][0][0]])
+
+
+class TestWorktrees(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.repo = nixpkgs_repo.Repo.__new__(nixpkgs_repo.Repo)
+        self.repo.worktrees = Path(tmpdir.name) / 'worktrees'
+        self.repo.max_worktrees = 1
+
+        def git(command, *args, **kwargs):
+            if command[:2] == ['worktree', 'add']:
+                os.makedirs(command[-2])
+        self.repo.git = git
+
+    def test_eviction(self):
+        with self.repo.worktree('a') as a:
+            with self.repo.worktree('b') as b:
+                # both are in use
+                self.assertTrue(os.path.exists(a))
+            self.assertTrue(os.path.exists(b))
+        # once released, only the most recently used is kept
+        self.assertEqual(1, len([p for p in self.repo.worktrees.iterdir() if p.is_dir()]))
+
+    def test_in_use_by_another_process(self):
+        path = str(self.repo.worktrees / 'a')
+        os.makedirs(path)
+        os.utime(path, (0, 0))
+        holder = ('import fcntl, sys, time; f = open(sys.argv[1], "a"); fcntl.flock(f, fcntl.LOCK_SH); '
+                  'print(flush=True); time.sleep(10)')
+        process = subprocess.Popen([sys.executable, '-c', holder, path + '.lock'], stdout=subprocess.PIPE)
+        self.addCleanup(process.stdout.close)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        process.stdout.readline()
+        with self.repo.worktree('b'):
+            pass
+        self.assertTrue(os.path.exists(path))
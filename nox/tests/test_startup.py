@@ -0,0 +1,44 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+# slow modules, which the commands must only import when they need them
+slow_modules = {'requests', 'psutil', 'pkg_resources', 'dogpile'}
+
+# how many times the start of a bare interpreter importing nox.search may take
+budget = 4
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run_python(code):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+    return json.loads(subprocess.check_output([sys.executable, '-c', code], env=env))
+
+
+def imported_by(module):
+    """Top-level modules loaded by importing module in a new interpreter"""
+    modules = run_python('import sys, json, {}; print(json.dumps(list(sys.modules)))'.format(module))
+    return {m.split('.')[0] for m in modules}
+
+
+class TestStartup(unittest.TestCase):
+    def test_search_imports(self):
+        self.assertEqual(set(), imported_by('nox.search') & slow_modules)
+
+    def test_update_imports(self):
+        self.assertEqual(set(), imported_by('nox.update') & slow_modules)
+
+    def test_review_imports(self):
+        self.assertEqual(set(), imported_by('nox.review') & {'requests', 'psutil', 'pkg_resources'})
+
+    def test_search_budget(self):
+        # relative to the machine's speed, which depends on its load
+        baseline = min(run_python('import subprocess, sys, time; start = time.perf_counter(); '
+                                  'subprocess.check_call([sys.executable, "-c", "pass"]); '
+                                  'print(time.perf_counter() - start)') for _ in range(3))
+        seconds = min(run_python('import time; start = time.perf_counter(); import nox.search; '
+                                 'print(time.perf_counter() - start)') for _ in range(3))
+        self.assertLess(seconds, budget * baseline)
@@ -0,0 +1,48 @@
+import json
+import os
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from dogpile.cache import make_region
+
+from .. import trace
+from ..cache import TracingProxy
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, 'trace.json')
+        patcher = mock.patch.multiple(trace, _path=self.path, _events=[])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_spans(self):
+        with trace.command_span(['true']):
+            subprocess.check_call(['true'])
+        with self.assertRaises(subprocess.CalledProcessError):
+            with trace.command_span(['false', '--flag'], 'false'):
+                subprocess.check_call(['false'])
+
+        region = make_region().configure('dogpile.cache.memory', wrap=[TracingProxy])
+        region.get('key')
+        region.set('key', 'value')
+        region.get('key')
+
+        trace.dump()
+        with open(self.path) as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual(['true', 'false', 'cache get', 'cache set', 'cache get'], [e['name'] for e in events])
+        self.assertEqual([0, 1], [e['args']['exit_code'] for e in events[:2]])
+        self.assertEqual('false --flag', events[1]['args']['command'])
+        self.assertEqual([False, True], [events[2]['args']['hit'], events[4]['args']['hit']])
+        self.assertIn(('cache', 'cache get', 2), [s[:3] for s in trace.summary(events)])
+
+    def test_disabled(self):
+        with mock.patch.object(trace, '_path', None):
+            with trace.span('nothing') as args:
+                args['recorded'] = False
+        self.assertEqual([], trace._events)
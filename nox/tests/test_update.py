@@ -0,0 +1,236 @@
+import gc
+import json
+import os
+import tempfile
+import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
+from unittest import mock
+
+from click.testing import CliRunner
+from dogpile.cache import make_region
+
+from .. import cache, update
+from .test_drv import write_drv
+
+
+class TestDiffPkgs(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = store = tmpdir.name
+
+        def drv(name, deps=(), output=None):
+            return write_drv(store, name, [('out', output or '/nix/store/out-' + name)], input_drvs=deps)
+
+        zlib = drv('zlib-1.2.11')
+        old_hello = drv('hello-2.10', [zlib])
+        new_hello = drv('hello-2.12', [zlib])
+        old_curl = drv('curl-7.58.0', [zlib])
+        new_curl = drv('curl-7.59.0', [zlib, drv('nghttp2-1.31.0')])
+        self.old = update.NixPath(drv('system-18.03', [old_hello, old_curl, drv('removed-1.0')]))
+        self.new = update.NixPath(drv('system-18.09', [new_hello, new_curl]))
+        self.paths = {'new_hello': new_hello, 'new_curl': new_curl}
+
+        patcher = mock.patch.object(cache, 'region', make_region().configure('dogpile.cache.memory'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch.object(update, 'changes_chunk_size', 2)
+    def test_remembered_in_chunks(self):
+        def changes():
+            return [(parent and parent.path, drv.path, change.ctype) for parent, drv, change
+                    in update.remembered_changes(self.old, self.new, {'max_level': 1})]
+        found = changes()
+        key = 'system-change-chunks:{}:{}:1'.format(self.old.path, self.new.path)
+        self.assertEqual(4, len(found))
+        self.assertEqual(2, cache.region.get(key))
+        self.assertEqual([2, 2], [len(cache.region.get('{}:{}'.format(key, i))) for i in range(2)])
+
+        with mock.patch.object(update, 'iter_changes') as iter_changes:
+            self.assertEqual(found, changes())
+            iter_changes.assert_not_called()
+        # found again from where the evicted chunk starts
+        cache.region.delete(key + ':1')
+        self.assertEqual(found, changes())
+        self.assertEqual(2, len(cache.region.get(key + ':1')))
+
+    def test_diff(self):
+        refs_tree = {}
+        update.diff_pkgs(refs_tree, self.old, self.new, {'max_level': 1})
+        root = refs_tree[self.new.path]
+        self.assertEqual(update.ChangeType.version, root.ctype)
+        self.assertEqual(['removed-1.0'], [p.full_name for p in root.removed])
+        self.assertEqual(update.ChangeType.version, refs_tree[self.paths['new_hello']].ctype)
+        curl = refs_tree[self.paths['new_curl']]
+        self.assertEqual(['nghttp2-1.31.0'], [p.full_name for p in curl.recursed])
+        self.assertEqual(update.ChangeType.new, refs_tree[curl.recursed[0].path].ctype)
+
+        update.DepsTree(refs_tree).show(self.new, {'quiet': False})
+
+    def test_concurrent_diff(self):
+        concurrent_refs_tree = {}
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            update.diff_pkgs(concurrent_refs_tree, self.old, self.new, {'max_level': 1}, executor=executor)
+        refs_tree = {}
+        update.diff_pkgs(refs_tree, self.old, self.new, {'max_level': 1})
+        self.assertEqual(list(refs_tree), list(concurrent_refs_tree))
+
+    def test_unused_loads_cancelled(self):
+        futures = []
+
+        class Executor:
+            def submit(self, *args):
+                futures.append(Future())
+                return futures[-1]
+
+        changes = update.iter_changes(self.old, self.new, {'max_level': 1}, executor=Executor())
+        next(changes)
+        changes.close()
+        self.assertTrue(futures)
+        self.assertTrue(all(f.cancelled() for f in futures))
+
+    def test_stream(self):
+        result = CliRunner().invoke(update.main, ['--max-level', '1', '--format', 'jsonl',
+                                                  self.old.path, self.new.path])
+        records = [json.loads(line) for line in result.output.splitlines()]
+        self.assertEqual(self.new.path, records[0]['path'])
+        self.assertEqual(['18.03', '18.09'], [records[0]['old_version'], records[0]['new_version']])
+        self.assertEqual(['version', 'version', 'new', 'version'], [r['change'] for r in records])
+        self.assertEqual(self.paths['new_curl'], records[2]['parent'])
+
+        result = CliRunner().invoke(update.main, ['--max-level', '1', '--format', 'json',
+                                                  self.old.path, self.new.path])
+        self.assertEqual(records, json.loads(result.output))
+
+    def test_fleet(self):
+        manifest = os.path.join(self.tmpdir, 'manifest')
+        with open(manifest, 'w') as f:
+            f.write('# host old new\nweb {0} {1}\n\ndb {0} {1}\n'.format(self.old.path, self.new.path))
+        result = CliRunner().invoke(update.main, ['--max-level', '1', '--format', 'jsonl', '--manifest', manifest])
+        records = [json.loads(line) for line in result.output.splitlines()]
+        self.assertEqual(['web'] * 4 + ['db'] * 4, [r['host'] for r in records[:-1]])
+        self.assertIn({'name': 'hello', 'change': 'version', 'old_version': '2.10', 'new_version': '2.12',
+                       'hosts': ['db', 'web']}, records[-1]['summary'])
+        result = CliRunner().invoke(update.main, ['--max-level', '1', '--format', 'json', '--manifest', manifest])
+        self.assertEqual(records, json.loads(result.output))
+
+        result = CliRunner().invoke(update.main, ['--manifest', manifest, self.old.path, self.new.path])
+        self.assertEqual(2, result.exit_code)
+        self.assertIn('Paths cannot be given with --manifest', result.output)
+
+        result = CliRunner().invoke(update.main, ['--max-level', '1', '--manifest', manifest])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertIn('==> db\n', result.output)
+        summary = result.output.split('==> Changes across all systems\n')[1].splitlines()
+        self.assertIn('   2 hosts  nghttp2  new', summary)
+        self.assertIn('   2 hosts  hello  2.10 -> 2.12', summary)
+
+    def test_drv_store(self):
+        store = update.DrvStore(os.path.join(self.tmpdir, 'drvs.sqlite'))
+        update.DrvGraph(store).references(self.new.path)
+        store.flush()
+
+        refs = update.DrvGraph().references(self.new.path)
+        os.unlink(self.new.path)
+        self.assertEqual(refs, update.DrvGraph(store).references(self.new.path))
+
+    def test_version_order(self):
+        versions = ['1.0pre1', '1.0', '1.0a', '1.0.1', '1.2', '1.10', '2.0-rc1', '2.0.0']
+        self.assertEqual(versions, sorted(reversed(versions), key=update.parse_version))
+
+    def test_interned(self):
+        self.assertIs(self.new, update.NixPath(self.new.path))
+        self.assertEqual('system', self.new.name)
+
+        path = update.NixPath('/nix/store/aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa-unused-1.0')
+        self.assertIn(path.path, update.NixPath._interned)
+        del path
+        gc.collect()
+        self.assertNotIn('/nix/store/aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa-unused-1.0', update.NixPath._interned)
+
+
+class TestShowDerivation(unittest.TestCase):
+    hello = '/nix/store/aaa-hello-2.10.drv'
+    zlib = '/nix/store/bbb-zlib-1.2.11.drv'
+
+    # nix show-derivation --recursive of nix 2.3
+    path_keyed = {
+        hello: {'outputs': {'out': {'path': '/nix/store/ccc-hello-2.10'}},
+                'inputDrvs': {zlib: ['out']}, 'inputSrcs': ['/nix/store/ddd-builder.sh'],
+                'system': 'x86_64-linux', 'builder': '/bin/sh', 'args': [], 'env': {}},
+        zlib: {'outputs': {'out': {'path': '/nix/store/eee-zlib-1.2.11'},
+                           'dev': {'path': '/nix/store/fff-zlib-1.2.11-dev'}},
+               'inputDrvs': {}, 'inputSrcs': [],
+               'system': 'x86_64-linux', 'builder': '/bin/sh', 'args': [], 'env': {}},
+    }
+
+    # nix derivation show --recursive of newer nix versions
+    store_relative = {
+        'version': 4,
+        'derivations': {
+            'aaa-hello-2.10.drv': {
+                'outputs': {'out': {'path': 'ccc-hello-2.10'}},
+                'inputs': {'drvs': {'bbb-zlib-1.2.11.drv': {'outputs': ['out'], 'dynamicOutputs': {}}},
+                           'srcs': ['ddd-builder.sh']},
+                'system': 'x86_64-linux', 'builder': '/bin/sh', 'args': [], 'env': {}},
+            'bbb-zlib-1.2.11.drv': {
+                'outputs': {'out': {'path': 'eee-zlib-1.2.11'}, 'dev': {'path': 'fff-zlib-1.2.11-dev'},
+                            'doc': {'hashAlgo': 'sha256', 'method': 'nar'}},
+                'inputs': {'drvs': {}, 'srcs': []},
+                'system': 'x86_64-linux', 'builder': '/bin/sh', 'args': [], 'env': {}},
+        },
+    }
+
+    def check(self, shown):
+        graph = update.DrvGraph()
+        with mock.patch.object(update, 'read_drv', side_effect=FileNotFoundError), \
+                mock.patch.object(update.subprocess, 'check_output', return_value=json.dumps(shown)), \
+                mock.patch.object(update, 'query') as query:
+            self.assertEqual({self.zlib, '/nix/store/ddd-builder.sh'}, graph.references(self.hello))
+            self.assertEqual({'/nix/store/ccc-hello-2.10'}, graph.outputs_of(self.hello))
+            # the whole closure was loaded at once
+            self.assertEqual(set(), graph.references(self.zlib))
+            self.assertEqual({'/nix/store/eee-zlib-1.2.11', '/nix/store/fff-zlib-1.2.11-dev'},
+                             graph.outputs_of(self.zlib))
+            query.assert_not_called()
+
+    def test_path_keyed(self):
+        self.check(self.path_keyed)
+
+    def test_store_relative(self):
+        self.check(self.store_relative)
+
+    def test_fallback(self):
+        graph = update.DrvGraph()
+        outputs = {'--references': self.zlib + '\n', '--outputs': '/nix/store/ccc-hello-2.10\n'}
+        with mock.patch.object(update, 'read_drv', side_effect=FileNotFoundError), \
+                mock.patch.object(update.subprocess, 'check_output', side_effect=FileNotFoundError), \
+                mock.patch.object(update, 'query', side_effect=lambda flag, drv: outputs[flag]):
+            self.assertEqual({self.zlib}, graph.references(self.hello))
+            self.assertEqual({'/nix/store/ccc-hello-2.10'}, graph.outputs_of(self.hello))
+
+
+class TestSystemDrv(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.old = write_drv(tmpdir.name, 'nixos-system-host-18.03', [('out', '/nix/store/out-old-system')])
+        self.new = write_drv(tmpdir.name, 'nixos-system-host-18.09', [('out', '/nix/store/out-system')])
+
+    @mock.patch('subprocess.check_output')
+    def test_instantiated(self, check_output):
+        check_output.return_value = self.new + '\n'
+        self.assertEqual(update.NixPath(self.new), update.new_system_drv(''))
+        # evaluation errors are shown
+        self.assertNotIn('stderr', check_output.call_args[1])
+
+    def test_changes_remembered(self):
+        systems = [(None, self.old, self.new)]
+        with mock.patch.object(cache, 'region', make_region().configure('dogpile.cache.memory')):
+            changes = list(update.system_changes(systems, {'max_level': 0}))
+            with mock.patch.object(update, 'iter_changes') as iter_changes:
+                self.assertEqual([(host, parent, drv.path, change.ctype, change.old.path)
+                                  for host, parent, drv, change in changes],
+                                 [(host, parent, drv.path, change.ctype, change.old.path)
+                                  for host, parent, drv, change in update.system_changes(systems, {'max_level': 0})])
+                iter_changes.assert_not_called()
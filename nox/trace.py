@@ -0,0 +1,102 @@
+"""Timing of what nox spends its time on, for --profile and NOX_TRACE
+
+Spans are only recorded once enable() was called. At exit, they are written
+as a Chrome trace (to open in chrome://tracing or https://ui.perfetto.dev),
+and the slowest kinds of spans are summed up on stderr.
+"""
+import atexit
+import functools
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import click
+
+_path = None
+_events = []
+
+
+def enable(path):
+    """Record spans, and write them to path at exit"""
+    global _path
+    if _path is None:
+        atexit.register(dump)
+    _path = path
+
+
+def enabled():
+    return _path is not None
+
+
+@contextmanager
+def span(name, category='nox', **args):
+    """Record the time spent in the block, with the given args
+
+    The block can add args to the dict it is given. A span of the
+    'subprocess' category also records the exit code of the command.
+    The peak memory of nox and of the commands it waited for so far are
+    recorded with each span.
+    """
+    if _path is None:
+        yield args
+        return
+    start = time.perf_counter()
+    try:
+        yield args
+        if category == 'subprocess':
+            args.setdefault('exit_code', 0)
+    except subprocess.CalledProcessError as e:
+        args['exit_code'] = e.returncode
+        raise
+    except BaseException as e:
+        args['error'] = type(e).__name__
+        raise
+    finally:
+        end = time.perf_counter()
+        args['maxrss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        args['children_maxrss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        _events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(),
+                        'tid': threading.get_ident(), 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                        'args': args})
+
+
+def command_span(command, name=None, **args):
+    """span of a subprocess running command, named after the program unless
+    a name is given"""
+    return span(name or command[0], 'subprocess', command=' '.join(map(str, command)), **args)
+
+
+def traced(f):
+    """Decorator recording a span for each call of f"""
+    @functools.wraps(f)
+    def _wrapped(*args, **kwargs):
+        with span(f.__name__):
+            return f(*args, **kwargs)
+    return _wrapped
+
+
+def summary(events, limit=15):
+    """(category, name, count, seconds) of the kinds of spans taking the most
+    time in total"""
+    totals = defaultdict(lambda: [0, 0.0])
+    for event in events:
+        total = totals[(event['cat'], event['name'])]
+        total[0] += 1
+        total[1] += event['dur'] / 1e6
+    return sorted(((cat, name, count, seconds) for (cat, name), (count, seconds) in totals.items()),
+                  key=lambda t: -t[3])[:limit]
+
+
+def dump():
+    if not _events:
+        return
+    with open(_path, 'w') as f:
+        json.dump({'traceEvents': _events, 'displayTimeUnit': 'ms'}, f)
+    click.echo('==> Trace written to {}'.format(_path), err=True)
+    for category, name, count, seconds in summary(_events):
+        click.echo('{:>9.2f}s {:>6}x  {:10}  {}'.format(seconds, count, category, name), err=True)
@@ -1,25 +1,215 @@
 import click
+import json
+import os
 import re
+import sqlite3
 import subprocess
+import threading
+import weakref
 
 from enum import Enum
 from bisect import bisect
-from pkg_resources import parse_version
 from pathlib import Path
-from characteristic import attributes
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import groupby
+
+from . import daemon, trace
+from .cachedir import cache_dir
+from .drv import read_drv
 
 def query(*args):
-    return subprocess.check_output(['nix-store', '--query'] + list(args),
-                                   universal_newlines=True)
+    command = ['nix-store', '--query'] + list(args)
+    with trace.command_span(command, 'nix-store --query'):
+        return subprocess.check_output(command, universal_newlines=True)
 
-@attributes(['full_name', 'path'], apply_with_init=False)
-class NixPath:
+
+class DrvStore:
+    """References and outputs of derivations, kept across runs in sqlite
+
+    Store paths are immutable, so the entries never need to be invalidated.
+    New entries are written by flush().
+    """
     def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS drvs (path TEXT PRIMARY KEY, refs TEXT, outputs TEXT)')
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def get(self, drv):
+        """(references, outputs) of drv, or None if it isn't known"""
+        with self.lock:
+            row = self.db.execute('SELECT refs, outputs FROM drvs WHERE path = ?', (drv,)).fetchone()
+        if row is None:
+            return None
+        return set(json.loads(row[0])), set(json.loads(row[1]))
+
+    def add(self, drv, refs, outputs):
+        with self.lock:
+            self.pending[drv] = (json.dumps(sorted(refs)), json.dumps(sorted(outputs)))
+
+    def flush(self):
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO drvs VALUES (?, ?, ?)',
+                                ((drv, refs, outputs) for drv, (refs, outputs) in self.pending.items()))
+            self.pending.clear()
+
+
+def parse_show_derivation(output, store_dir):
+    """{path: (references, outputs)} of the derivations shown by nix
+    show-derivation
+
+    Older nix versions key the derivations by store path, and list their
+    inputDrvs and inputSrcs. Newer ones put them under "derivations", with
+    paths relative to the store and the inputs under "inputs". Outputs
+    whose path isn't known yet (content-addressed) are left out.
+    """
+    def store_path(path):
+        return path if path.startswith('/') else os.path.join(store_dir, path)
+
+    shown = json.loads(output)
+    if 'derivations' in shown:
+        shown = shown['derivations']
+    closure = {}
+    for path, info in shown.items():
+        inputs = info.get('inputs', {})
+        drvs = inputs.get('drvs', info.get('inputDrvs', {}))
+        srcs = inputs.get('srcs', info.get('inputSrcs', []))
+        outputs = {store_path(o['path']) for o in info['outputs'].values() if 'path' in o}
+        closure[store_path(path)] = ({store_path(p) for p in list(drvs) + list(srcs)}, outputs)
+    return closure
+
+
+class DrvGraph:
+    """References and outputs of derivations, memoized per path
+
+    Derivations are read straight from their .drv file. When that isn't
+    possible, the whole closure of the derivation is queried at once with
+    `nix show-derivation --recursive`, or failing that nix-store.
+    With a store, what was loaded in earlier runs is looked up there first.
+    Derivations can be loaded from several threads at once.
+    """
+    def __init__(self, store=None):
+        self.refs = {}
+        self.outputs = {}
+        self.store = store
+        self.lock = threading.Lock()
+
+    def _add(self, drv, refs, outputs):
+        with self.lock:
+            self.refs[drv] = refs
+            self.outputs[drv] = outputs
+        if self.store:
+            self.store.add(drv, refs, outputs)
+
+    def load(self, drv):
+        stored = self.store and self.store.get(drv)
+        if stored:
+            with self.lock:
+                self.refs[drv], self.outputs[drv] = stored
+            return
+        try:
+            derivation = read_drv(drv)
+        except (OSError, ValueError):
+            self.query(drv)
+        else:
+            self._add(drv, set(derivation.input_drvs) | set(derivation.input_srcs),
+                      set(derivation.outputs.values()))
+
+    def query(self, drv):
+        env = dict(os.environ)
+        env['NIX_CONFIG'] = env.get('NIX_CONFIG', '') + '\nextra-experimental-features = nix-command'
+        command = ['nix', 'show-derivation', '--recursive', drv]
+        try:
+            with trace.command_span(command, 'nix show-derivation'):
+                output = subprocess.check_output(command, universal_newlines=True, env=env)
+            for path, (refs, outputs) in parse_show_derivation(output, os.path.dirname(drv)).items():
+                self._add(path, refs, outputs)
+        except (OSError, subprocess.CalledProcessError, ValueError, KeyError):
+            pass
+        if drv not in self.refs:
+            # no usable nix command, fall back to querying this derivation only
+            self._add(drv, set(query('--references', drv).strip().split('\n')),
+                      set(query('--outputs', drv).strip().split('\n')))
+
+    def clear(self):
+        """Forget the derivations loaded so far"""
+        with self.lock:
+            self.refs = {}
+            self.outputs = {}
+
+    def references(self, drv):
+        if drv not in self.refs:
+            self.load(drv)
+        return self.refs[drv]
+
+    def outputs_of(self, drv):
+        if drv not in self.outputs:
+            self.load(drv)
+        return self.outputs[drv]
+
+
+graph = DrvGraph()
+
+
+_version_component = re.compile(r'\d+|[^\d.-]+')
+
+
+def parse_version(version):
+    """Sort key of a version, ordered like builtins.compareVersions does
+
+    The version is split in numbers and words. Numbers are compared as
+    such and come after words, "pre" comes before everything, and a missing
+    component before anything but "pre", so that 1.0pre < 1.0 < 1.0a < 1.0.1.
+    """
+    key = []
+    for component in _version_component.findall(version):
+        if component.isdigit():
+            key.append((3, int(component)))
+        elif component == 'pre':
+            key.append((0, ''))
+        else:
+            key.append((2, component))
+    # end of the version, as a missing component
+    key.append((1, ''))
+    return tuple(key)
+
+
+def name_start(path):
+    """Index of the name in a store path, after the 32 characters hash"""
+    return path.rfind('/') + 34
+
+
+class NixPath:
+    """A store path, with its name and version parsed once
+
+    NixPaths are interned: NixPath(path) always returns the same instance for
+    a given path, so each path of a closure is parsed and stored only once.
+    Only the instances still in use are remembered, so that a long-running
+    process doesn't keep every path it has seen.
+    """
+    __slots__ = ('path', 'is_drv', 'full_name', 'name', 'version', 'extension',
+                 'shortversion', '_parsed_version', '_refs', '__weakref__')
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, path):
+        self = cls._interned.get(path)
+        if self is None:
+            self = super().__new__(cls)
+            self._parse(path)
+            # another thread may have interned the path meanwhile
+            self = cls._interned.setdefault(path, self)
+        return self
+
+    def _parse(self, path):
         self.path = path
         self.is_drv = self.path.endswith('.drv')
         name_slice_end = -4 if self.is_drv else None
-        self.full_name = self.path[44:name_slice_end]
+        # skip the store directory and the hash
+        self.full_name = self.path[name_start(self.path):name_slice_end]
+        self._parsed_version = None
+        self._refs = None
 
         m = re.search(r'-(\d.*)', self.full_name)
         if m:
@@ -38,11 +228,25 @@ class NixPath:
             self.extension = None
             self.shortversion = None
 
+    def __lt__(self, other):
+        return (self.full_name, self.path) < (other.full_name, other.path)
+
+    def __repr__(self):
+        return 'NixPath({!r})'.format(self.path)
+
+    @property
+    def parsed_version(self):
+        if self._parsed_version is None and self.version:
+            self._parsed_version = parse_version(self.version)
+        return self._parsed_version
+
     def refs(self):
-        return {NixPath(p) for p in query('--references', self.path).strip().split('\n')}
+        if self._refs is None:
+            self._refs = frozenset(NixPath(p) for p in graph.references(self.path))
+        return self._refs
 
     def outputs(self):
-        return set(query('--outputs', self.path).strip().split('\n'))
+        return graph.outputs_of(self.path)
 
 
 def current_system_drv(old_path):
@@ -50,10 +254,27 @@ def current_system_drv(old_path):
     return NixPath(current_system if current_system.endswith('.drv') else query('--deriver', current_system).strip())
 
 
+def instantiate_system():
+    """Path of the derivation of the system built from the configuration
+
+    The configuration is evaluated every time, as what it reads can't be
+    known beforehand: the changes are remembered by derivation instead.
+    """
+    command = ['nix-instantiate', '<nixpkgs/nixos>', '-A', 'system']
+    with trace.command_span(command):
+        return subprocess.check_output(command, universal_newlines=True).strip()
+
+
 def new_system_drv(new_path):
     if new_path:
       new_system = str(Path(new_path).resolve())
       return NixPath(new_system if new_system.endswith('.drv') else query('--deriver', new_system).strip())
+    try:
+        return NixPath(instantiate_system())
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    # no usable configuration in NIX_PATH, ask nixos-rebuild
     with subprocess.Popen(['nixos-rebuild', 'dry-run'],
                           stderr=subprocess.PIPE,
                           universal_newlines=True) as process:
@@ -67,95 +288,88 @@ def display_path(pkg, bold):
     is_drv = pkg.is_drv
     name_slice_end = -4 if is_drv else None
     path = pkg.path
-    return (path[:44] +
-            click.style(path[44:name_slice_end], bold=bold) +
+    start = name_start(path)
+    return (path[:start] +
+            click.style(path[start:name_slice_end], bold=bold) +
             (path[name_slice_end:] if is_drv else ''))
 
 ChangeType = Enum('ChangeType', 'source fixed expression new version normal')
 
-class DepsTree:
-    def __init__(self, refs_tree):
-        self.seen = set()
-        self.refs_tree = refs_tree
-
-    def show(self, pkg, opts, level=0):
-        ctype = self.refs_tree[pkg.path][1]
-        if pkg.path not in self.seen and (not opts['quiet'] or ctype != ChangeType.fixed):
-            self.seen.add(pkg.path)
-            click.echo('  '*level + display_path(pkg, bold=True) + ' : ', nl=False)
-            if ctype == ChangeType.source:
-                click.secho('Source file changed', bold=True)
-            elif ctype == ChangeType.fixed:
-                click.secho('Fixed-output derivation changed', bold=True)
-            elif ctype == ChangeType.expression:
-                click.secho('Expression changed', bold=True)
-            elif ctype == ChangeType.new:
-                click.secho('seems to be new', bold=True)
-            elif ctype == ChangeType.version:
-                opkg = self.refs_tree[pkg.path][2]
-                if opkg.extension == pkg.extension:
-                    click.secho('new version ({} -> {})'.format(opkg.shortversion, pkg.shortversion), bold=True)
-                else:
-                    click.secho('new version ({} -> {})'.format(opkg.version, pkg.version), bold=True)
-            elif ctype == ChangeType.normal:
-                click.echo()
-
-            if self.refs_tree[pkg.path][0]:
-                (removed_packages, recurse_packages) = self.refs_tree[pkg.path][3:]
-                level=level+1
-                for rpkg in removed_packages:
-                    click.echo('  '*level + display_path(rpkg, bold=True) + ' : seems to be removed')
-                for rpkg in recurse_packages:
-                    self.show(rpkg, opts, level)
-        elif not opts['quiet']:
-            click.echo('  '*level + display_path(pkg, bold=False) + ' [...]')
-
-def diff_pkgs(refs_tree, current_drv, new_drv, opts, level=0):
-    if new_drv.path in refs_tree:
-        return
 
-    if not current_drv:
-        refs_tree[new_drv.path] = (False, ChangeType.new, current_drv)
-        return
+class Change:
+    """How a derivation differs from the one it replaces (old)
 
-    if not current_drv.is_drv or not new_drv.is_drv:
-        refs_tree[new_drv.path] = (False, ChangeType.source, current_drv)
-        return
+    When the references of both were compared (expanded), removed lists the
+    references only in the old one and recursed those only in the new one.
+    """
+    __slots__ = ('ctype', 'old', 'removed', 'recursed')
 
-    ctype = ChangeType.normal
-    if current_drv.version != new_drv.version:
-        if level > opts['max_level']:
-          refs_tree[new_drv.path] = (False, ChangeType.version, current_drv)
-          return
-        else:
-          ctype = ChangeType.version
+    def __init__(self, ctype, old, removed=None, recursed=None):
+        self.ctype = ctype
+        self.old = old
+        self.removed = removed
+        self.recursed = recursed
 
-    # Fixed-output derivation changed, but content didn't
-    if current_drv.outputs() == new_drv.outputs():
-        if level > opts['max_level']:
-          refs_tree[new_drv.path] = (False, ChangeType.fixed, current_drv)
-          return
-        else:
-          ctype = ChangeType.fixed
+    @property
+    def expanded(self):
+        return self.recursed is not None
 
-    old_pkgs = current_drv.refs()
-    new_pkgs = new_drv.refs()
 
-    if old_pkgs == new_pkgs:
-        refs_tree[new_drv.path] = (False, ChangeType.expression if ctype == ChangeType.normal else ctype, current_drv);
-        return
+class DepsTree:
+    def __init__(self, refs_tree):
+        self.seen = set()
+        self.refs_tree = refs_tree
 
-    removed_packages = old_pkgs - new_pkgs
+    def show(self, pkg, opts, level=0):
+        stack = [(pkg, level)]
+        while stack:
+            pkg, level = stack.pop()
+            change = self.refs_tree[pkg.path]
+            ctype = change.ctype
+            if pkg.path not in self.seen and (not opts['quiet'] or ctype != ChangeType.fixed):
+                self.seen.add(pkg.path)
+                click.echo('  '*level + display_path(pkg, bold=True) + ' : ', nl=False)
+                if ctype == ChangeType.source:
+                    click.secho('Source file changed', bold=True)
+                elif ctype == ChangeType.fixed:
+                    click.secho('Fixed-output derivation changed', bold=True)
+                elif ctype == ChangeType.expression:
+                    click.secho('Expression changed', bold=True)
+                elif ctype == ChangeType.new:
+                    click.secho('seems to be new', bold=True)
+                elif ctype == ChangeType.version:
+                    opkg = change.old
+                    if opkg.extension == pkg.extension:
+                        click.secho('new version ({} -> {})'.format(opkg.shortversion, pkg.shortversion), bold=True)
+                    else:
+                        click.secho('new version ({} -> {})'.format(opkg.version, pkg.version), bold=True)
+                elif ctype == ChangeType.normal:
+                    click.echo()
+
+                if change.expanded:
+                    for rpkg in change.removed:
+                        click.echo('  '*(level+1) + display_path(rpkg, bold=True) + ' : seems to be removed')
+                    stack.extend((rpkg, level+1) for rpkg in reversed(change.recursed))
+            elif not opts['quiet']:
+                click.echo('  '*level + display_path(pkg, bold=False) + ' [...]')
+
+
+def pair_packages(removed_packages, recurse_packages):
+    """Match each new reference with the old one it replaces, if any
+
+    Returns the (previous, new) pairs, previous being None for new packages,
+    and removes the matched old references from removed_packages.
+    """
     current_fullnames = defaultdict(list)
     current_names = defaultdict(list)
-    for drv in removed_packages:
-      current_fullnames[drv.full_name].append(drv)
-      if drv.version:
-        current_names[(drv.name, bool(drv.extension))].append((parse_version(drv.version), drv))
+    for drv in sorted(removed_packages):
+        current_fullnames[drv.full_name].append(drv)
+        if drv.version:
+            current_names[(drv.name, bool(drv.extension))].append((drv.parsed_version, drv))
     for l in current_names.values():
         l.sort()
 
-    recurse_packages = new_pkgs - old_pkgs
+    pairs = []
     for pkg in recurse_packages:
         previous = None
         pkgs = current_fullnames[pkg.full_name]
@@ -163,39 +377,364 @@ def diff_pkgs(refs_tree, current_drv, new_drv, opts, level=0):
             previous = pkgs[0]
         elif pkg.version:
             versions = current_names[(pkg.name, bool(pkg.extension))]
-            v = parse_version(pkg.version)
-            prev = bisect(versions, (v, pkg)) - 1
+            prev = bisect(versions, (pkg.parsed_version, pkg)) - 1
             if prev >= 0:
                 previous = versions[prev][1]
 
         if previous:
             current_fullnames[previous.full_name].remove(previous)
             if previous.version:
-                current_names[(previous.name, bool(previous.extension))].remove((parse_version(previous.version), previous))
+                current_names[(previous.name, bool(previous.extension))].remove((previous.parsed_version, previous))
             removed_packages.discard(previous)
+        pairs.append((previous, pkg))
+    return pairs
+
+
+def load_pair(current_drv, new_drv):
+    """Load what compare() needs about both derivations"""
+    for drv in (current_drv, new_drv):
+        if drv and drv.is_drv:
+            graph.references(drv.path)
+
+
+def iter_changes(current_drv, new_drv, opts, level=0, executor=None, seen=None):
+    """Yield (parent, derivation, Change) for each derivation of the new
+    closure that differs from the current one, as they are found
+
+    The closure is explored depth first, each derivation once, skipping
+    the paths in seen. With an executor, the derivations to compare next
+    are loaded in the background while the current ones are compared. The
+    comparisons still happen in order, so the result is the same. The
+    loads which turn out not to be needed are cancelled.
+    """
+    seen = set() if seen is None else seen
+    loading = {}
+    stack = [(None, current_drv, new_drv, level)]
+    try:
+        while stack:
+            parent, current_drv, new_drv, level = stack.pop()
+            future = loading.pop((current_drv, new_drv), None)
+            if new_drv.path in seen:
+                if future:
+                    future.cancel()
+                continue
+            seen.add(new_drv.path)
+            if future:
+                future.result()
+            change, pairs = compare(current_drv, new_drv, opts, level)
+            if executor:
+                for pair in pairs:
+                    if pair not in loading and pair[1].path not in seen:
+                        loading[pair] = executor.submit(load_pair, *pair)
+            yield parent, new_drv, change
+            stack.extend((new_drv, previous, pkg, level + 1) for previous, pkg in reversed(pairs))
+    finally:
+        # when the consumer stopped early
+        for future in loading.values():
+            future.cancel()
+
+
+def encode_change(parent, drv, change):
+    """Serializable form of a change found by iter_changes"""
+    def paths(pkgs):
+        return None if pkgs is None else [p.path for p in pkgs]
+    return (parent and parent.path, drv.path, change.ctype.name, change.old and change.old.path,
+            paths(change.removed), paths(change.recursed))
+
+
+def decode_change(encoded):
+    """(parent, derivation, Change) encoded by encode_change"""
+    def pkgs(paths):
+        return None if paths is None else [NixPath(p) for p in paths]
+    parent, drv, ctype, old, removed, recursed = encoded
+    return (parent and NixPath(parent), NixPath(drv),
+            Change(ChangeType[ctype], old and NixPath(old), pkgs(removed), pkgs(recursed)))
+
+
+def found_changes(current_drv, new_drv, opts, executor=None):
+    """(encoded change, change or None) for each change of iter_changes
+
+    When the daemon is running, it finds them from what it already loaded,
+    and they are left to decode.
+    """
+    try:
+        for encoded in daemon.stream('changes', current=current_drv.path, new=new_drv.path,
+                                     max_level=opts['max_level']):
+            yield encoded, None
+        return
+    except daemon.Unavailable:
+        pass
+    for parent, drv, change in iter_changes(current_drv, new_drv, opts, executor=executor):
+        yield encode_change(parent, drv, change), (parent, drv, change)
+
+
+# changes remembered in each cache entry
+changes_chunk_size = 1000
+
+
+def remembered_changes(current_drv, new_drv, opts, executor=None):
+    """iter_changes, remembered for the pair of derivations
+
+    Derivations never change, so the changes between two of them found
+    once are valid forever. They are remembered in chunks as they are
+    found, the number of chunks marking that they were all found. Should
+    a chunk be evicted, the changes are found again from there.
+    """
+    # the region is only loaded when needed, as it's slow to import
+    from dogpile.cache.api import NO_VALUE
+    from .cache import region
+
+    key = 'system-change-chunks:{}:{}:{}'.format(current_drv.path, new_drv.path, opts['max_level'])
+    chunks = region.get(key, ignore_expiration=True)
+    remembered = 0
+    if chunks is not NO_VALUE:
+        for i in range(chunks):
+            chunk = region.get('{}:{}'.format(key, i), ignore_expiration=True)
+            if chunk is NO_VALUE:
+                break
+            for change in chunk:
+                yield decode_change(change)
+            remembered += len(chunk)
+        else:
+            return
+
+    chunk, chunks = [], 0
+    for i, (encoded, change) in enumerate(found_changes(current_drv, new_drv, opts, executor)):
+        if i >= remembered:
+            yield change or decode_change(encoded)
+        chunk.append(encoded)
+        if len(chunk) == changes_chunk_size:
+            region.set('{}:{}'.format(key, chunks), chunk)
+            chunk, chunks = [], chunks + 1
+    if chunk:
+        region.set('{}:{}'.format(key, chunks), chunk)
+        chunks += 1
+    region.set(key, chunks)
+
+
+def diff_pkgs(refs_tree, current_drv, new_drv, opts, level=0, executor=None):
+    """Fill refs_tree with the Change of each derivation of the new closure
+    that differs from the current one"""
+    for _, drv, change in iter_changes(current_drv, new_drv, opts, level, executor, set(refs_tree)):
+        refs_tree[drv.path] = change
+
+
+def compare(current_drv, new_drv, opts, level):
+    """The Change from current_drv to new_drv, and the pairs of references
+    to compare next"""
+    if not current_drv:
+        return Change(ChangeType.new, current_drv), []
 
-        diff_pkgs(refs_tree, previous, pkg, opts, level + 1)
+    if not current_drv.is_drv or not new_drv.is_drv:
+        return Change(ChangeType.source, current_drv), []
 
-    refs_tree[new_drv.path] = (True, ctype, current_drv, sorted(removed_packages), sorted(recurse_packages))
+    ctype = ChangeType.normal
+    if current_drv.version != new_drv.version:
+        if level > opts['max_level']:
+            return Change(ChangeType.version, current_drv), []
+        ctype = ChangeType.version
+
+    # Fixed-output derivation changed, but content didn't
+    if current_drv.outputs() == new_drv.outputs():
+        if level > opts['max_level']:
+            return Change(ChangeType.fixed, current_drv), []
+        ctype = ChangeType.fixed
+
+    old_pkgs = current_drv.refs()
+    new_pkgs = new_drv.refs()
+
+    if old_pkgs == new_pkgs:
+        return Change(ChangeType.expression if ctype == ChangeType.normal else ctype, current_drv), []
+
+    removed_packages = set(old_pkgs - new_pkgs)
+    recurse_packages = sorted(new_pkgs - old_pkgs)
+    pairs = pair_packages(removed_packages, recurse_packages)
+    return Change(ctype, current_drv, sorted(removed_packages), recurse_packages), pairs
+
+
+def change_record(parent, drv, change):
+    """json-able description of a change found by iter_changes"""
+    return {
+        'path': drv.path,
+        'change': change.ctype.name,
+        'old_path': change.old.path if change.old else None,
+        'old_version': change.old.version if change.old else None,
+        'new_version': drv.version,
+        'parent': parent.path if parent else None,
+        'removed': [p.path for p in change.removed] if change.expanded else [],
+    }
+
+
+def read_manifest(f):
+    """(host, old path, new path) for each "host old-path new-path" line of f
+
+    Blank lines and lines starting with # are ignored.
+    """
+    systems = []
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) != 3:
+            raise click.BadParameter('line {}: expected "host old-path new-path"'.format(number),
+                                     param_hint='--manifest')
+        systems.append(tuple(fields))
+    return systems
+
+
+def system_changes(systems, opts, executor=None):
+    """Yield (host, parent, derivation, Change) for the changes of each
+    (host, old path, new path) system
+
+    All the systems share the derivation graph, so what their closures
+    have in common is only loaded once, and the changes between two
+    systems are only searched the first time. Systems without update yield a
+    single (host, None, None, None).
+    """
+    for host, old_path, new_path in systems:
+        new_drv = new_system_drv(new_path)
+        current_drv = new_drv and current_system_drv(old_path)
+        if not new_drv or new_drv is current_drv:
+            yield host, None, None, None
+            continue
+        for parent, drv, change in remembered_changes(current_drv, new_drv, opts, executor):
+            yield host, parent, drv, change
+
+
+def stream_changes(changes, opts, summary=None):
+    """Print the changes as soon as they are found, as json
+
+    With a summary, filled by fleet_summary() while the changes are found,
+    it is printed last, as a {"summary": [...]} record.
+    """
+    jsonl = opts['output_format'] == 'jsonl'
+    first = True
+
+    def echo(record):
+        nonlocal first
+        record = json.dumps(record)
+        if not jsonl and not first:
+            record = ',\n' + record
+        click.echo(record, nl=jsonl)
+        first = False
+
+    if not jsonl:
+        click.echo('[')
+    for host, parent, drv, change in changes:
+        if change is None or opts['quiet'] and change.ctype == ChangeType.fixed:
+            continue
+        record = change_record(parent, drv, change)
+        if host is not None:
+            record['host'] = host
+        echo(record)
+    if summary is not None:
+        echo({'summary': [{'name': name, 'change': ctype.name, 'old_version': old_version,
+                           'new_version': new_version, 'hosts': sorted(hosts)}
+                          for (name, old_version, new_version, ctype), hosts in sorted_summary(summary)]})
+    if not jsonl:
+        click.echo('\n]')
+
+
+def show_changes(changes, opts):
+    """Print the tree of changes of each system"""
+    for host, host_changes in groupby(changes, key=lambda c: c[0]):
+        if host is not None:
+            click.secho('==> {}'.format(host), bold=True)
+        refs_tree = {}
+        root = None
+        for _, parent, drv, change in host_changes:
+            if drv is None:
+                click.echo('No system updates')
+                break
+            root = root or drv
+            refs_tree[drv.path] = change
+        if root:
+            DepsTree(refs_tree).show(root, opts)
+
+
+def fleet_summary(changes, summary):
+    """Pass the changes through, counting the hosts of each new version,
+    new package and changed source in summary"""
+    for host, parent, drv, change in changes:
+        if change and change.ctype in (ChangeType.version, ChangeType.new, ChangeType.source):
+            old_version = change.old.version if change.old else None
+            summary[(drv.name, old_version, drv.version, change.ctype)].add(host)
+        yield host, parent, drv, change
+
+
+def sorted_summary(summary):
+    """The items of the fleet_summary, the most widespread first"""
+    return sorted(summary.items(), key=lambda item: (-len(item[1]), item[0][0], str(item[0][2])))
+
+
+def show_fleet_summary(summary):
+    """Print what changed across the systems, the most widespread first"""
+    click.secho('==> Changes across all systems', bold=True)
+    descriptions = {ChangeType.new: 'new', ChangeType.source: 'source changed'}
+    for (name, old_version, new_version, ctype), hosts in sorted_summary(summary):
+        if ctype == ChangeType.version:
+            description = '{} -> {}'.format(old_version, new_version)
+        else:
+            description = descriptions[ctype]
+        click.echo('{:>4} host{}  {}  {}'.format(len(hosts), ' ' if len(hosts) == 1 else 's',
+                                                click.style(name, bold=True), description))
 
 
 @click.command()
 @click.option('--max-level', default=0, type=click.INT)
 @click.option('--quiet', default=False, is_flag=True)
-@click.argument('old-path', default='', type=click.Path(exists=True))
-@click.argument('new-path', default='', type=click.Path(exists=True))
-def main(old_path, new_path, **opts):
-    new_drv = new_system_drv(new_path)
-    if not new_drv:
-        click.echo('No system updates')
-        return
-
-    current_drv = current_system_drv(old_path)
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1),
+              help='Number of derivations to load at the same time')
+@click.option('--format', 'output_format', default='tree', type=click.Choice(['tree', 'json', 'jsonl']),
+              help='json and jsonl stream the changes as they are found, '
+                   'as a json array or one json object per line, '
+                   'followed by a summary record when several systems are compared')
+@click.option('--manifest', type=click.File(),
+              help='File listing the systems to compare, as "host old-path new-path" lines')
+@click.option('--drv-cache', default=False, is_flag=True,
+              help='Remember the derivations loaded, for the next runs')
+@click.option('--profile', type=click.Path(dir_okay=False), envvar='NOX_TRACE',
+              help='Write a Chrome trace of where the time goes to this file')
+@click.argument('paths', nargs=-1, type=click.Path(exists=True))
+def main(paths, manifest, drv_cache, profile, **opts):
+    """Show what changed between the OLD and NEW systems, given as pairs
+    of paths, by default the current and the next NixOS system"""
+    if profile:
+        trace.enable(profile)
+    if manifest and paths:
+        raise click.UsageError('Paths cannot be given with --manifest')
+    if manifest:
+        systems = read_manifest(manifest)
+    elif len(paths) <= 2:
+        old_path, new_path = paths + ('',) * (2 - len(paths))
+        systems = [(None, old_path, new_path)]
+    elif len(paths) % 2:
+        raise click.UsageError('Expected pairs of old and new paths')
+    else:
+        systems = [(new_path, old_path, new_path) for old_path, new_path in zip(paths[::2], paths[1::2])]
+
+    if drv_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+        graph.store = DrvStore(os.path.join(cache_dir, 'drvs.sqlite'))
+
+    summary = defaultdict(set)
+    with ExitStack() as stack:
+        executor = None
+        if opts['jobs'] > 1:
+            executor = stack.enter_context(ThreadPoolExecutor(max_workers=opts['jobs']))
+        changes = system_changes(systems, opts, executor=executor)
+        if len(systems) > 1:
+            changes = fleet_summary(changes, summary)
+        if opts['output_format'] == 'tree':
+            show_changes(changes, opts)
+        else:
+            stream_changes(changes, opts, summary if len(systems) > 1 else None)
 
-    refs_tree = {}
-    diff_pkgs(refs_tree, current_drv, new_drv, opts)
-    tree = DepsTree(refs_tree)
-    tree.show(new_drv, opts)
+    if len(systems) > 1 and opts['output_format'] == 'tree':
+        show_fleet_summary(summary)
+    if graph.store:
+        graph.store.flush()
 
 # TODO : option -> display only thing to install, deps tree without
 # repetition, deps tree with omission of repeated paths, or full tree
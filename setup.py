@@ -3,7 +3,7 @@ from setuptools import setup
 setup(
     setup_requires=['pbr'],
     pbr=True,
-    package_data={'': ['enumerate_tests.nix']},
+    package_data={'': ['*.nix']},
     include_package_data=True,
     test_suite="nox.tests"
 )